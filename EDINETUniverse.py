@@ -1,4 +1,12 @@
 import pandas as pd
+import UniverseCache as uc
+import SecurityMaster as sm
+
+def _download_topix_weights_xlsx():
+    fn = 'https://www.jpx.co.jp/markets/indices/topix/tvdivq00000030ne-att/TOPIX_weight_jp.xlsx'
+    tpx = pd.read_excel(fn, engine='openpyxl', dtype=str)
+    tpx = tpx.loc[~tpx['コード'].isnull()]
+    return tpx
 
 class EDINETUniverse:
     def __init__(self):
@@ -7,24 +15,25 @@ class EDINETUniverse:
                         # uji.bean=ee.bean.W1E62071.EEW1E62071Bean&uji.verb=
                         # W1E62071InitDisplay&TID=W1E62071&PID=W0EZ0001&SESSIONKEY=&lgKbn=2&dflg=0&iflg=0
                 
-    def get_edinet_list(self):
-        fn = 'DATA/edinet_list/20210713.csv'
-        df = pd.read_csv(fn, encoding='cp932', skiprows=1, dtype=str)
-        df = df[df['上場区分']=='上場']
-        df.loc[:, 'ticker'] = df['証券コード'].str.slice(0, 4)
-        self.edf = df
+    def get_edinet_list(self, asof=None):
+        """
+        listed companies of the EDINET code list snapshot valid at asof (default latest),
+        see SecurityMaster
+        """
+        self.sm = sm.get_security_master(asof)
+        self.edf = self.sm.get_df()
         return self
     
     def get_topix_universe(self):
-        fn = 'https://www.jpx.co.jp/markets/indices/topix/tvdivq00000030ne-att/TOPIX_weight_jp.xlsx'
-        tpx = pd.read_excel(fn, engine='openpyxl', dtype=str)
-        tpx = tpx.loc[~tpx['コード'].isnull()]
+        cache = uc.get_universe_cache('jpx_topix_weight_xlsx', _download_topix_weights_xlsx,
+                                      codecol='コード')
+        tpx = cache.get_df()
         tpx = tpx.rename(columns={'コード':'ticker'})
         self.df = tpx
         return self
     
     def add_edinet_code(self):
-        self.df = self.df.merge(self.edf, on='ticker', how='left')
+        self.df = self.sm.join(self.df, on='ticker')
         return self
     
     def add_features(self):
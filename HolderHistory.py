@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import pandas as pd
+import storage as st
+import SecurityMaster as sm
+
+
+def get_history_columns():
+    """
+    columns kept per filing, see ParseLargeHolders.get_summary_table
+    """
+    textcols = ['docID',
+                'edinet_code_dei_jpdei_cor',
+                'filer_name_in_japanese_dei_jpdei_cor',
+                'filer_name_in_english_dei_jpdei_cor',
+                'security_code_dei_jpdei_cor',
+                'document_type_dei_jpdei_cor',
+                'security_code_of_issuer',
+                'name_of_issuer',
+                'filing_date_cover_page',
+                'date_when_filing_requirement_arose_cover_page',
+                'base_date',
+                'purpose_of_holding',
+                'reason_for_filing_change_report_cover_page',
+                'reason_for_filing_change_report_cover_page_na',
+                'document_title_cover_page',
+                'residential_address_or_address_of_registered_headquarter_cover_page',
+                'name_cover_page',
+                'place_of_filing_cover_page',
+                'act_of_making_important_proposal_etc',
+                'act_of_making_important_proposal_etc_na',
+                'significant_contracts_related_to_said_stocks_etc_such_as_collateral_agreements_na',
+                'significant_contracts_related_to_said_stocks_etc_such_as_collateral_agreements_text_block']
+    numcols = ['holding_ratio_of_share_certificates_etc',
+               'holding_ratio_of_share_certificates_etc_per_last_report',
+               'stocks_or_investment_securities_etc_article27233_item2',
+               'stocks_or_investment_securities_etc_article27233_main_clause',
+               'total_article27233_item2',
+               'total_article27233_main_clause',
+               'total_number_of_outstanding_stocks_etc',
+               'total_number_of_stocks_etc_held',
+               'number_of_submission_dei_jpdei_cor',
+               'total_number_of_filers_and_joint_holders_cover_page',
+               'total_amount_from_other_sources',
+               'total_amount_of_funding_for_acquisition']
+    return textcols, numcols
+
+
+class LargeHolderHistory:
+    """
+    Incremental multi-year store of the parsed large-holder summaries (ParseLargeHolders.sumrytbl)
+    in a local SQLite file. One row per docID, tagged with the EDINET date it was filed on.
+    Secondary indexes on security_code_of_issuer and edinet_code_dei_jpdei_cor make
+    "all filings on ticker X" and "all positions of holder E0xxxx" index lookups
+    instead of reading every daily file.
+    """
+    def __init__(self, fn=None):
+        if fn is None:
+            fn = os.path.join('DATA', 'tairyohoyu', 'history.sqlite')
+        fdir = os.path.dirname(fn)
+        if fdir:
+            os.makedirs(fdir, exist_ok=True)
+        self.fn = fn
+        self.textcols, self.numcols = get_history_columns()
+        self.con = sqlite3.connect(fn)
+        self._create_tables()
+
+    def _create_tables(self):
+        cols = ['"date" TEXT NOT NULL', '"docID" TEXT PRIMARY KEY']
+        cols += ['"{x}" TEXT'.format(x=x) for x in self.textcols if x != 'docID']
+        cols += ['"{x}" REAL'.format(x=x) for x in self.numcols]
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS filings ({cols})'.format(cols=', '.join(cols)))
+            self.con.execute('CREATE INDEX IF NOT EXISTS idx_issuer ON filings '
+                             '(security_code_of_issuer, filing_date_cover_page)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS idx_filer ON filings '
+                             '(edinet_code_dei_jpdei_cor, filing_date_cover_page)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS idx_date ON filings ("date")')
+            self.con.execute('CREATE TABLE IF NOT EXISTS loaded_dates '
+                             '("date" TEXT PRIMARY KEY, nrows INTEGER, loaded_at TEXT)')
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def append(self, sumrytbl:pd.DataFrame, dt:pd.Timestamp):
+        """
+        Adds one parsed day. Re-appending a day replaces all of its rows, so reparses are
+        idempotent, also when a docID disappeared from the day (e.g. a withdrawn filing).
+        """
+        df = sumrytbl.reindex(columns=self.textcols + self.numcols)
+        for x in self.numcols:
+            df[x] = pd.to_numeric(df[x], errors='coerce')
+        for x in self.textcols:
+            df[x] = df[x].astype(str).where(df[x].notnull())
+        df = df.drop_duplicates(subset=['docID'], keep='last')
+        dtstr = dt.strftime('%Y-%m-%d')
+        df.insert(0, 'date', dtstr)
+        df = df.astype(object).where(df.notnull(), None)
+        cols = ', '.join(['"{x}"'.format(x=x) for x in df.columns])
+        qmarks = ', '.join(['?'] * df.shape[1])
+        with self.con:
+            self.con.execute('DELETE FROM filings WHERE "date"=?', (dtstr,))
+            self.con.executemany('INSERT OR REPLACE INTO filings ({cols}) VALUES ({qmarks})'
+                                 .format(cols=cols, qmarks=qmarks),
+                                 df.itertuples(index=False, name=None))
+            self.con.execute('INSERT OR REPLACE INTO loaded_dates VALUES (?, ?, ?)',
+                             (dtstr, df.shape[0], pd.Timestamp.now().isoformat()))
+        return self
+
+    def get_loaded_dates(self):
+        df = pd.read_sql('SELECT "date" FROM loaded_dates ORDER BY "date"', self.con)
+        return pd.to_datetime(df['date']).tolist()
+
+    def sync_from_cloud(self, dates):
+        """
+        Appends the daily summary csvs of all dates not loaded yet.
+        """
+        loaded = set(self.get_loaded_dates())
+        for dt in dates:
+            if dt in loaded:
+                continue
+            fn = 'tairyohoyu/parsed/summary/{YYYYMMDD}.csv.gz'.format(YYYYMMDD=dt.strftime('%Y%m%d'))
+            try:
+                sdf = st.get_storage().read_csv(fn, dtype=str)
+            except FileNotFoundError:
+                continue
+            self.append(sdf, dt)
+        return self
+
+    def _query(self, where:str, params):
+        sql = 'SELECT * FROM filings WHERE {where} ORDER BY filing_date_cover_page, "date", docID'.format(where=where)
+        return pd.read_sql(sql, self.con, params=params)
+
+    def get_filings_for_ticker(self, code:str):
+        """
+        all filings on an issuer, code can be the 4-digit ticker or the 5-digit secCode
+        (filings report either), see SecurityMaster.get_issuer_codes
+        """
+        return self._query('security_code_of_issuer IN (?, ?)', sm.get_issuer_codes(code))
+
+    def get_filings_for_holder(self, edinetcode:str, code:str=None):
+        """
+        time series of all positions reported by one filer, optionally restricted to one issuer
+        """
+        df = self._query('edinet_code_dei_jpdei_cor = ?', [edinetcode])
+        if code is not None:
+            df = df.loc[df['security_code_of_issuer'].isin(sm.get_issuer_codes(code))]
+        return df
@@ -1,26 +1,185 @@
 import os
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+
+def normalize_column_name(col:str):
+    #same normalization as IndexMaster.rename_columns
+    return col.lower().replace(' ', '')
+
+def get_index_master_dtypes():
+    """
+    dtypes by normalized column name; columns not listed are inferred
+    """
+    dtypes = {'indexclassification': 'category',
+              'name': 'object',
+              'localcode': 'object',
+              'no.ofshares': 'int64',
+              'changeinno.ofshares': 'int64',
+              'no.ofsharesbeforeffw': 'int64'}
+    return dtypes
+
+def parse_index_master_file(fn:str):
+    """
+    One shift-jis index master csv with explicit dtypes. Share counts fall back
+    to float if a file has blanks in them.
+    """
+    header = pd.read_csv(fn, encoding='shift-jis', nrows=0).columns
+    dtypes = get_index_master_dtypes()
+    dtype = {x: dtypes[normalize_column_name(x)] for x in header if normalize_column_name(x) in dtypes}
+    try:
+        df = pd.read_csv(fn, encoding='shift-jis', parse_dates=['Date'], dtype=dtype)
+    except ValueError:
+        dtype = {k: ('float64' if v == 'int64' else v) for k, v in dtype.items()}
+        df = pd.read_csv(fn, encoding='shift-jis', parse_dates=['Date'], dtype=dtype)
+    return df
+
+def get_shard_fn(fn:str, cachedir:str):
+    """
+    parquet shard of fn, keyed by the file's mtime and size so that a replaced file is reparsed
+    """
+    stat = os.stat(fn)
+    stem = os.path.basename(fn)[:-len('.csv')]
+    return os.path.join(cachedir, '{stem}_{mtime}_{size}.parquet'.format(stem=stem, mtime=stat.st_mtime_ns,
+                                                                          size=stat.st_size))
+
+def load_index_master_file(fn:str, cachedir:str=None):
+    """
+    parses fn, or reads its cached shard if fn did not change since
+    """
+    if cachedir is None:
+        return parse_index_master_file(fn)
+    shardfn = get_shard_fn(fn, cachedir)
+    if os.path.exists(shardfn):
+        return pd.read_parquet(shardfn)
+    df = parse_index_master_file(fn)
+    os.makedirs(cachedir, exist_ok=True)
+    stem = os.path.basename(fn)[:-len('.csv')]
+    #drop shards of older versions of the same file
+    for x in os.listdir(cachedir):
+        if x.startswith(stem + '_') and x.endswith('.parquet') and x.count('_') == stem.count('_') + 2:
+            os.remove(os.path.join(cachedir, x))
+    tmpfn = '{fn}.{pid}.part'.format(fn=shardfn, pid=os.getpid())
+    df.to_parquet(tmpfn, index=False)
+    os.replace(tmpfn, shardfn)
+    return df
+
+
+def get_ts_feature_specs():
+    """
+    (new column, column, group columns, 'shift' or 'diff', periods) computed by add_ts_features
+    """
+    specs = [('prev_indexname', 'indexname', ('ticker',), 'shift', 1),
+             ('prev_no.ofsharesbeforeffw', 'no.ofsharesbeforeffw', ('ticker',), 'shift', 1),
+             ('prev_ffw', 'ffw', ('ticker', 'indexname'), 'shift', 1),
+             ('dffw', 'ffw', ('ticker', 'indexname'), 'diff', 1)]
+    return specs
+
+
+class GroupedShifter:
+    """
+    groupby(groupcols)[col].shift/diff for a frame that is already in time order.
+    Group codes are computed once per set of group columns; a stable argsort puts each
+    group's rows next to each other without changing their order, and the position of a
+    row within its group masks out values that would leak in from the previous group.
+    Rows with a missing group key get NaN, like in groupby.
+    """
+    def __init__(self, df:pd.DataFrame):
+        self.df = df
+        self.groupings = {}
+
+    def _get_grouping(self, groupcols):
+        groupcols = tuple(groupcols)
+        if groupcols not in self.groupings:
+            codes = np.zeros(self.df.shape[0], dtype=np.int64)
+            valid = np.ones(self.df.shape[0], dtype=bool)
+            for x in groupcols:
+                icodes, uniques = pd.factorize(self.df[x])
+                valid &= icodes >= 0
+                codes = codes * (len(uniques) + 1) + icodes
+            order = np.argsort(codes, kind='stable')
+            scodes = codes[order]
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = scodes[1:] != scodes[:-1]
+            idx = np.arange(len(order))
+            pos = idx - np.maximum.accumulate(np.where(first, idx, 0))
+            self.groupings[groupcols] = (order, pos, valid)
+        return self.groupings[groupcols]
+
+    def _shift_values(self, vals, groupcols, periods, fill):
+        order, pos, valid = self._get_grouping(groupcols)
+        svals = vals[order]
+        res = np.full(len(svals), fill, dtype=svals.dtype)
+        if periods < len(svals):
+            res[periods:] = svals[:len(svals) - periods]
+        res[pos < periods] = fill
+        out = np.empty_like(res)
+        out[order] = res
+        out[~valid] = fill
+        return out
+
+    def shift(self, col:str, groupcols, periods:int=1):
+        s = self.df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            codes = self._shift_values(s.cat.codes.to_numpy(), groupcols, periods, -1)
+            return pd.Series(pd.Categorical.from_codes(codes, dtype=s.dtype), index=s.index)
+        if s.dtype.kind in 'biuf':
+            vals, fill = s.to_numpy(dtype=np.float64), np.nan
+        elif s.dtype.kind == 'M':
+            vals, fill = s.to_numpy(), np.datetime64('NaT')
+        else:
+            vals, fill = s.to_numpy(dtype=object), np.nan
+        return pd.Series(self._shift_values(vals, groupcols, periods, fill), index=s.index)
+
+    def diff(self, col:str, groupcols, periods:int=1):
+        vals = self.df[col].to_numpy(dtype=np.float64)
+        prev = self._shift_values(vals, groupcols, periods, np.nan)
+        return pd.Series(vals - prev, index=self.df.index)
 
 class IndexMaster:
     """
     Parses Index Master files that can be purchased on the JPX webpage http://db-ec.jpx.co.jp/category/C700/.
     As of 2021/06/28, the page only sells 12 months of historical data.
     """
-    def __init__(self, fdir=None):
+    def __init__(self, fdir=None, cachedir=None):
         if fdir is None:
             self.fdir = './DATA/index_master/'
         else:
             self.fdir = fdir
+        if cachedir is None:
+            cachedir = os.path.join(self.fdir, 'cache')
+        self.cachedir = cachedir
         self.df = None
     
-    def parse_files(self):
-        def parse_file(fn):
-            df = pd.read_csv(fn, encoding='shift-jis',
-                             parse_dates=['Date'])
-            return df
-        fns = os.listdir(self.fdir)
-        df = [parse_file(os.path.join(self.fdir, fn)) for fn in fns]
-        df = pd.concat(df).reset_index(drop=True)
+    def list_files(self):
+        return [os.path.join(self.fdir, fn) for fn in sorted(os.listdir(self.fdir)) if fn.lower().endswith('.csv')]
+
+    def parse_files(self, max_workers=None, use_cache=True, fns=None):
+        """
+        Reads all *.csv in fdir (or just fns). Parsed files are cached as parquet shards in cachedir,
+        so a daily run only parses the new file; new files are parsed in a process pool.
+        """
+        if fns is None:
+            fns = self.list_files()
+        cachedir = self.cachedir if use_cache else None
+        dfs = {}
+        if cachedir is not None:
+            for fn in fns:
+                shardfn = get_shard_fn(fn, cachedir)
+                if os.path.exists(shardfn):
+                    dfs[fn] = pd.read_parquet(shardfn)
+        newfns = [fn for fn in fns if fn not in dfs]
+        if len(newfns) > 1 and (max_workers is None or max_workers > 1):
+            with ProcessPoolExecutor(max_workers=max_workers) as ex:
+                dfs.update(zip(newfns, ex.map(load_index_master_file, newfns, [cachedir] * len(newfns))))
+        else:
+            dfs.update([(fn, load_index_master_file(fn, cachedir)) for fn in newfns])
+        df = pd.concat([dfs[fn] for fn in fns]).reset_index(drop=True)
+        #the category sets differ per file, concat falls back to object
+        for x in df.columns:
+            if get_index_master_dtypes().get(normalize_column_name(x)) == 'category':
+                df[x] = df[x].astype('category')
         self.df = df
         return self
     
@@ -28,30 +187,34 @@ class IndexMaster:
         """
         convert column names to lower case. Identify data type of columns
         """
-        self.df.columns = self.df.columns.str.lower().str.replace(' ', '')
+        self.df.columns = [normalize_column_name(x) for x in self.df.columns]
         rendict = {'indexclassification':'indexname'}
         self.df = self.df.rename(columns=rendict)
         return self
 
-    def add_ts_features(self):
+    def add_ts_features(self, extra_features=None):
         """
         Add features to Index Master:
         'code': standard 4-digit ticker code as a string
         'dffw': dffw = ffw(t) - ffw(t-1)
         'abs_dffw': abs_dffw = |dffw|
-        '
+        extra_features: more (newcol, col, groupcols, 'shift' or 'diff', periods) specs,
+        computed together with get_ts_feature_specs()
         """
         df = self.df
         df.loc[:, 'ticker'] = df['localcode'].astype(str).str.slice(0, 4)
         df = df.sort_values(['date', 'localcode', 'indexname'])
-        df.loc[:, 'prev_indexname'] = df.groupby('ticker')['indexname'].shift(1)
-        df.loc[:, 'prev_no.ofsharesbeforeffw'] = df.groupby('ticker')['no.ofsharesbeforeffw'].shift(1)
-        groupcols = ['ticker', 'indexname']
-        df.loc[:, 'prev_ffw'] = df.groupby(groupcols)['ffw'].shift(1)
-        df.loc[:, 'dffw'] = df.groupby(groupcols)['ffw'].diff()
+        specs = get_ts_feature_specs()
+        if extra_features is not None:
+            specs = specs + list(extra_features)
+        gs = GroupedShifter(df)
+        for newcol, col, groupcols, op, periods in specs:
+            if op == 'shift':
+                df[newcol] = gs.shift(col, groupcols, periods)
+            else:
+                df[newcol] = gs.diff(col, groupcols, periods)
         df.loc[:, 'abs_dffw'] = df['dffw'].abs()
         df.loc[:, 'old_shares'] = df['no.ofshares'] - df['changeinno.ofshares']
-        df.loc[:, 'old_shares'] = df['no.ofshares'] - df['changeinno.ofshares']
         self.df = df
         return self
 
@@ -66,10 +229,112 @@ class IndexMaster:
 
     def get_topix_ffw_changes(self):
         df = self.df
-        kcols = ['date', 'ticker', 'name', 'changeinno.ofshares', 'no.ofshares',
-                 'ffw', 'prev_ffw', 'dffw', 'abs_dffw']
+        kcols = get_ffw_event_columns()
         df = df.query('eventtype == "topix_ffw_change"')\
                .sort_values('abs_dffw', ascending=False).loc[:, kcols]
         return df
 
 
+def get_ffw_event_columns():
+    kcols = ['date', 'ticker', 'name', 'changeinno.ofshares', 'no.ofshares',
+             'ffw', 'prev_ffw', 'dffw', 'abs_dffw']
+    return kcols
+
+
+class FFWEventStore:
+    """
+    Incremental topix_ffw_change detection. Instead of recomputing the whole history,
+    the store keeps the last row per (ticker, indexname) in state.parquet, which is all
+    that add_ts_features looks back at (the last row per ticker is one of them).
+    update() runs the features on state + new rows only and appends the new events to
+    events.csv, with the columns of IndexMaster.get_topix_ffw_changes.
+    files.csv lists the index master files already processed.
+    """
+    def __init__(self, fdir=None):
+        if fdir is None:
+            fdir = os.path.join('DATA', 'index_master_events')
+        self.fdir = fdir
+        self.statefn = os.path.join(fdir, 'state.parquet')
+        self.eventsfn = os.path.join(fdir, 'events.csv')
+        self.filesfn = os.path.join(fdir, 'files.csv')
+        self.state = None
+        self.files = []
+        self.newevents = None
+
+    def load(self):
+        if os.path.exists(self.statefn):
+            self.state = pd.read_parquet(self.statefn)
+        if os.path.exists(self.filesfn):
+            self.files = pd.read_csv(self.filesfn)['fn'].tolist()
+        return self
+
+    def get_last_date(self):
+        if self.state is None or self.state.shape[0] == 0:
+            return None
+        return self.state['date'].max()
+
+    def update(self, df:pd.DataFrame, fns=()):
+        """
+        df: index master rows after rename_columns; rows up to the last processed date are ignored
+        """
+        basecols = list(df.columns)
+        lastdate = self.get_last_date()
+        if lastdate is not None:
+            df = df.loc[df['date'] > lastdate]
+        self.files = self.files + [x for x in fns if x not in self.files]
+        if df.shape[0] == 0:
+            return self
+        df = df.assign(is_new=True)
+        if self.state is not None:
+            df = pd.concat([self.state[basecols].assign(is_new=False), df], ignore_index=True)
+        im = IndexMaster()
+        im.df = df
+        im = im.add_ts_features().add_event_flags()
+        df = im.df
+        new = df.loc[df['is_new']]
+        newevents = new.loc[new['eventtype'] == 'topix_ffw_change', get_ffw_event_columns()]
+        #not saved yet from an earlier update
+        if self.newevents is not None:
+            newevents = pd.concat([self.newevents, newevents])
+        self.newevents = newevents
+        #add_ts_features sorted by date, so the last row per group is the latest one
+        self.state = df.drop_duplicates(subset=['ticker', 'indexname'], keep='last').loc[:, basecols]\
+                       .reset_index(drop=True)
+        return self
+
+    def save(self):
+        os.makedirs(self.fdir, exist_ok=True)
+        if self.newevents is not None and self.newevents.shape[0] > 0:
+            self.newevents.to_csv(self.eventsfn, mode='a', header=not os.path.exists(self.eventsfn), index=False)
+        self.newevents = None
+        if self.state is not None:
+            tmpfn = self.statefn + '.part'
+            self.state.to_parquet(tmpfn, index=False)
+            os.replace(tmpfn, self.statefn)
+        pd.DataFrame({'fn': self.files}).to_csv(self.filesfn, index=False)
+        return self
+
+    def get_events(self):
+        """
+        all events so far, ordered like get_topix_ffw_changes
+        """
+        if not os.path.exists(self.eventsfn):
+            return pd.DataFrame(columns=get_ffw_event_columns())
+        df = pd.read_csv(self.eventsfn, parse_dates=['date'], dtype={'ticker': str})
+        return df.sort_values('abs_dffw', ascending=False)
+
+
+def run_ffw_events_incremental(fdir=None, storedir=None):
+    """
+    Processes the index master files not seen yet and appends their topix_ffw_change events.
+    Returns the store; store.get_events() has the full event list.
+    """
+    im = IndexMaster(fdir)
+    store = FFWEventStore(storedir).load()
+    fns = [x for x in im.list_files() if x not in store.files]
+    if len(fns) == 0:
+        return store
+    im = im.parse_files(fns=fns).rename_columns()
+    return store.update(im.df, fns).save()
+
+
@@ -0,0 +1,180 @@
+import os
+import re
+import unicodedata
+import lxml.html
+import lxml.etree
+import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+
+
+def get_section_headings():
+    #section -> heading text in the 提出会社の状況 page, the table right after it is the section
+    headings = {'major_holders': '大株主の状況',
+                'shares_outstanding': '発行済株式'}
+    return headings
+
+def get_column_keywords():
+    #first matching keyword renames the column, checked in order
+    keywords = {'major_holders': [('割合', 'ratio'),
+                                  ('所有株式数', 'shares'),
+                                  ('氏名', 'name'),
+                                  ('住所', 'address')],
+                'shares_outstanding': [('事業年度末', 'issued_fy_end'),
+                                       ('提出日', 'issued_filing_date'),
+                                       ('取引所', 'exchange'),
+                                       ('種類', 'share_class'),
+                                       ('内容', 'description')]}
+    return keywords
+
+def get_numeric_columns():
+    return {'major_holders': ['shares', 'ratio'],
+            'shares_outstanding': ['issued_fy_end', 'issued_filing_date']}
+
+
+def normalize_text(txt:str):
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', txt))
+
+def to_number(s:pd.Series):
+    """
+    '1,234' -> 1234, dashes and blanks -> NaN
+    """
+    s = s.astype(str).str.replace(',', '', regex=False).str.replace(r'[^\d.\-]', '', regex=True)
+    return pd.to_numeric(s, errors='coerce')
+
+
+class KaishaJokyoParser:
+    """
+    Parses one saved 提出会社の状況 page (see YuhoScraper.save_content), named
+    output/kaishajokyo/{code}_{YYYYMMDD}.html. The file is parsed once with lxml;
+    build_index walks it in document order and maps every section heading to the
+    first table after it, so each section costs a lookup instead of another pass.
+    kp = KaishaJokyoParser(fn).load().build_index()
+    kp.get_major_holders(), kp.get_shares_outstanding()
+    """
+    def __init__(self, fn:str):
+        self.fn = fn
+        parts = os.path.basename(fn).split('.')[0].split('_')
+        self.code = parts[0]
+        self.date = pd.to_datetime(parts[1], format='%Y%m%d', errors='coerce') if len(parts) > 1 else pd.NaT
+        self.doc = None
+        self.tables = []
+        self.index = {}
+
+    def load(self):
+        with open(self.fn, 'r', encoding='utf-8') as f:
+            self.doc = lxml.html.fromstring(f.read())
+        return self
+
+    def build_index(self):
+        """
+        self.tables: all tables in document order
+        self.index: section -> position in self.tables
+        """
+        headings = get_section_headings()
+        seen = set()
+        self.tables = []
+        self.index = {}
+        depth = 0
+        for event, el in lxml.etree.iterwalk(self.doc, events=('start', 'end')):
+            if event == 'start':
+                if el.tag == 'table':
+                    for section in seen:
+                        self.index[section] = len(self.tables)
+                    seen = set()
+                    self.tables.append(el)
+                    depth += 1
+                txt = el.text if isinstance(el.tag, str) else None
+            else:
+                if el.tag == 'table':
+                    depth -= 1
+                txt = el.tail
+            #headings sit outside the tables, only their first occurrence counts
+            if txt and depth == 0:
+                for section, heading in headings.items():
+                    if section not in self.index and heading in txt:
+                        seen.add(section)
+        return self
+
+    def get_table(self, section:str):
+        """
+        raw table of section as strings, first row as header; None if the section is missing
+        """
+        if section not in self.index:
+            return None
+        rows = []
+        for tr in self.tables[self.index[section]].iter('tr'):
+            rows.append([normalize_text(x.text_content()) for x in tr.xpath('./td|./th')])
+        rows = [x for x in rows if any(x)]
+        if len(rows) < 2:
+            return None
+        ncols = max([len(x) for x in rows])
+        rows = [x + [''] * (ncols - len(x)) for x in rows]
+        return pd.DataFrame(rows[1:], columns=rows[0])
+
+    def _get_typed_table(self, section:str):
+        df = self.get_table(section)
+        if df is None:
+            return None
+        renames = {}
+        for col in df.columns:
+            for keyword, name in get_column_keywords()[section]:
+                if keyword in col and name not in renames.values():
+                    renames[col] = name
+                    break
+        units = {renames[x]: x for x in renames.keys()}
+        df = df.rename(columns=renames)
+        df = df.loc[:, ~df.columns.duplicated()]
+        for x in get_numeric_columns()[section]:
+            if x in df.columns:
+                df[x] = to_number(df[x])
+                if '千株' in units.get(x, ''):
+                    df[x] = df[x] * 1000
+        df.insert(0, 'code', self.code)
+        df.insert(1, 'date', self.date)
+        df['fn'] = self.fn
+        return df
+
+    def get_major_holders(self):
+        df = self._get_typed_table('major_holders')
+        if df is not None and 'name' in df.columns:
+            df['is_total'] = df['name'].isin(['計', '合計'])
+        return df
+
+    def get_shares_outstanding(self):
+        return self._get_typed_table('shares_outstanding')
+
+
+def parse_kaishajokyo_file(fn:str):
+    """
+    (major holders, shares outstanding, error message) for one file, runs in the worker processes
+    """
+    try:
+        kp = KaishaJokyoParser(fn).load().build_index()
+        return kp.get_major_holders(), kp.get_shares_outstanding(), None
+    except Exception as e:
+        return None, None, '{fn}: {e}'.format(fn=fn, e=e)
+
+def parse_kaishajokyo_files(fns=None, max_workers=None, chunksize:int=16):
+    """
+    Parses saved kaishajokyo pages in a process pool, by default all of output/kaishajokyo.
+    Returns the major holders frame, the shares outstanding frame and the failed files.
+    """
+    if fns is None:
+        fdir = os.path.join('output', 'kaishajokyo')
+        fns = [os.path.join(fdir, x) for x in sorted(os.listdir(fdir)) if x.endswith('.html')]
+    holders = []
+    shares = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=max_workers) as ex:
+        for hdf, sdf, err in tqdm(ex.map(parse_kaishajokyo_file, fns, chunksize=chunksize), total=len(fns)):
+            if err is not None:
+                failed.append(err)
+                continue
+            if hdf is not None:
+                holders.append(hdf)
+            if sdf is not None:
+                shares.append(sdf)
+    holders = pd.concat(holders, ignore_index=True) if holders else pd.DataFrame()
+    shares = pd.concat(shares, ignore_index=True) if shares else pd.DataFrame()
+    return holders, shares, failed
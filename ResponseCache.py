@@ -0,0 +1,216 @@
+import os
+import time
+import zlib
+import struct
+import hashlib
+import threading
+
+
+def get_response_cache_defaults():
+    #maxbytes: total size of the compressed payloads before least recently used entries are evicted
+    #today_ttl: seconds a listing fetched while its day was still being filed stays valid
+    defaults = {'maxbytes': 10 * 1024**3,
+                'today_ttl': 600}
+    return defaults
+
+
+def get_cache_key(endpoint:str, key:str, typ:str):
+    """
+    content address of one API response, e.g. ('documents.json', '2024-06-03', '2')
+    or ('documents', 'S100XXXX', '5'); the subscription key is never part of it
+    """
+    txt = '{endpoint}|{key}|{typ}'.format(endpoint=endpoint, key=key, typ=typ)
+    return hashlib.sha256(txt.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk cache of EDINET API responses, zlib compressed:
+    {cachedir}/{sha[:2]}/{sha}.z
+    Each file starts with the fetch time, so ttl checks survive the mtime touch that
+    marks an entry as recently used. Entries without ttl never expire (issued documents
+    are immutable), they only leave the cache through LRU eviction above maxbytes.
+    """
+    HEADER = struct.Struct('<d')
+
+    def __init__(self, cachedir:str, maxbytes:int=None):
+        if maxbytes is None:
+            maxbytes = get_response_cache_defaults()['maxbytes']
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.totalbytes = None
+        self.lock = threading.Lock()
+
+    def _fn(self, sha:str):
+        return os.path.join(self.cachedir, sha[:2], sha + '.z')
+
+    def get(self, endpoint:str, key:str, typ:str, ttl:float=None, final_after:float=None):
+        """
+        cached payload as bytes, None on a miss or an expired entry.
+        With final_after (epoch seconds, e.g. the end of a listed day) ttl only applies to
+        entries fetched before it; entries fetched later never expire.
+        """
+        fn = self._fn(get_cache_key(endpoint, key, typ))
+        try:
+            with open(fn, 'rb') as f:
+                fetched, = self.HEADER.unpack(f.read(self.HEADER.size))
+                expires = ttl is not None and (final_after is None or fetched < final_after)
+                if expires and (time.time() - fetched) > ttl:
+                    return None
+                payload = zlib.decompress(f.read())
+        except (FileNotFoundError, struct.error, zlib.error):
+            return None
+        try:
+            os.utime(fn)
+        except OSError:
+            pass
+        return payload
+
+    def put(self, endpoint:str, key:str, typ:str, payload:bytes):
+        writer = CacheWriter(self, endpoint, key, typ)
+        writer.write(payload)
+        writer.commit()
+        return self
+
+    def tee(self, strm, endpoint:str, key:str, typ:str, size:int=None):
+        """
+        wraps a readable stream, everything read through it is also written to the cache;
+        size is the expected number of bytes (Content-Length) if known
+        """
+        return TeeReader(strm, CacheWriter(self, endpoint, key, typ), size=size)
+
+    def _added(self, nbytes:int):
+        with self.lock:
+            if self.totalbytes is None:
+                self.totalbytes = self._scan_size()
+            else:
+                self.totalbytes += nbytes
+            if self.totalbytes > self.maxbytes:
+                self._evict()
+
+    def _list_entries(self):
+        entries = []
+        for dirpath, _, fns in os.walk(self.cachedir):
+            for fn in fns:
+                if not fn.endswith('.z'):
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self):
+        return sum([x[1] for x in self._list_entries()])
+
+    def _evict(self):
+        #least recently used first, down to 90% of maxbytes so that not every put evicts
+        entries = sorted(self._list_entries())
+        total = sum([x[1] for x in entries])
+        target = 0.9 * self.maxbytes
+        for _, nbytes, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= nbytes
+        self.totalbytes = total
+
+
+class CacheWriter:
+    """
+    Compresses chunks into a temp file; commit() moves it into place, abort() drops it.
+    """
+    def __init__(self, cache:ResponseCache, endpoint:str, key:str, typ:str):
+        self.cache = cache
+        self.fn = cache._fn(get_cache_key(endpoint, key, typ))
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        self.tmpfn = '{fn}.{pid}_{tid}.part'.format(fn=self.fn, pid=os.getpid(), tid=threading.get_ident())
+        self.f = open(self.tmpfn, 'wb')
+        self.f.write(ResponseCache.HEADER.pack(time.time()))
+        self.compressor = zlib.compressobj()
+
+    def write(self, chunk:bytes):
+        self.f.write(self.compressor.compress(chunk))
+
+    def commit(self):
+        self.f.write(self.compressor.flush())
+        self.f.close()
+        nbytes = os.path.getsize(self.tmpfn)
+        os.replace(self.tmpfn, self.fn)
+        self.cache._added(nbytes)
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.remove(self.tmpfn)
+        except FileNotFoundError:
+            pass
+
+
+class TeeReader:
+    """
+    File-like read() over strm that copies every chunk into a CacheWriter.
+    tell() counts the bytes read so far, resumable uploads (google cloud storage) need it.
+    close() commits the entry only if strm was read to the end. Uploads often read exactly
+    once (read(size) or read()) without the empty read that signals the end, so the end is
+    also reached at the expected size, after a read of everything, or checked on close.
+    """
+    def __init__(self, strm, writer:CacheWriter, size:int=None):
+        self.strm = strm
+        self.writer = writer
+        self.size = size
+        self.pos = 0
+        self.eof = False
+        self.closed = False
+
+    def read(self, size=-1):
+        chunk = self.strm.read(size)
+        if chunk:
+            self.writer.write(chunk)
+            self.pos += len(chunk)
+        if (not chunk and size != 0) or size is None or size < 0:
+            self.eof = True
+        elif self.size is not None and self.pos >= self.size:
+            self.eof = True
+        return chunk
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.eof:
+            try:
+                self.eof = self.strm.read(1) == b''
+            except Exception:
+                pass
+        if self.eof:
+            self.writer.commit()
+        else:
+            self.writer.abort()
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+def get_response_cache(config=None):
+    """
+    Cache for config['http_cache_dir'] (or $EDINET_HTTP_CACHE_DIR), one per directory and process.
+    Returns None if neither is set, i.e. caching is opt-in.
+    """
+    if config is None:
+        config = {}
+    cachedir = config.get('http_cache_dir', os.environ.get('EDINET_HTTP_CACHE_DIR'))
+    if not cachedir:
+        return None
+    with _CACHES_LOCK:
+        if cachedir not in _CACHES:
+            _CACHES[cachedir] = ResponseCache(cachedir, config.get('http_cache_maxbytes'))
+    return _CACHES[cachedir]
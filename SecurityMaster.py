@@ -0,0 +1,182 @@
+import os
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+
+
+def get_security_master_dir():
+    fdir = os.environ.get('SECURITY_MASTER_DIR')
+    if fdir is None:
+        fdir = os.path.join('DATA', 'edinet_list')
+    return fdir
+
+def get_edinet_list_columns():
+    #columns of the EDINET code list (EdinetcodeDlInfo.csv) -> identifier columns added next to them
+    return {'ＥＤＩＮＥＴコード': 'edinetcode',
+            '証券コード': 'secCode',
+            '提出者法人番号': 'jcn'}
+
+def get_identifier_columns():
+    return ['edinetcode', 'ticker', 'secCode', 'jcn']
+
+
+def list_snapshots(fdir=None):
+    """
+    as-of date -> file for all YYYYMMDD.csv snapshots of the EDINET code list
+    """
+    if fdir is None:
+        fdir = get_security_master_dir()
+    snapshots = {}
+    for fn in os.listdir(fdir):
+        dt = pd.to_datetime(fn.split('.')[0], format='%Y%m%d', errors='coerce')
+        if fn.endswith('.csv') and not pd.isnull(dt):
+            snapshots[dt] = os.path.join(fdir, fn)
+    return dict(sorted(snapshots.items()))
+
+def save_snapshot(fn:str, dt:pd.Timestamp=None, fdir=None):
+    """
+    stores a downloaded EdinetcodeDlInfo.csv as the snapshot of date dt (default today)
+    """
+    if fdir is None:
+        fdir = get_security_master_dir()
+    if dt is None:
+        dt = pd.Timestamp.now()
+    os.makedirs(fdir, exist_ok=True)
+    tofn = os.path.join(fdir, dt.strftime('%Y%m%d') + '.csv')
+    shutil.copyfile(fn, tofn)
+    return tofn
+
+
+class SecurityMaster:
+    """
+    One snapshot of the EDINET code list with dict indexes between EDINET code,
+    4-digit ticker, 5-digit secCode and JCN (法人番号). Snapshots are the files
+    {fdir}/YYYYMMDD.csv; asof picks the latest snapshot on or before that date.
+    Use get_security_master(), which parses each snapshot once per process.
+    sm.lookup(df['edinetCode'], 'edinetcode', 'secCode')
+    sm.join(df, on='ticker')
+    """
+    def __init__(self, asof=None, fdir=None, listed_only=True):
+        if fdir is None:
+            fdir = get_security_master_dir()
+        snapshots = list_snapshots(fdir)
+        if asof is not None:
+            snapshots = {k: v for k, v in snapshots.items() if k <= pd.Timestamp(asof)}
+        if len(snapshots) == 0:
+            raise FileNotFoundError('no EDINET code list snapshot in {fdir} as of {asof}'.format(fdir=fdir, asof=asof))
+        self.asof, self.fn = list(snapshots.items())[-1]
+        self.listed_only = listed_only
+        self.df = None
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        df = pd.read_csv(self.fn, encoding='cp932', skiprows=1, dtype=str)
+        if self.listed_only:
+            df = df[df['上場区分']=='上場']
+        df = df.reset_index(drop=True)
+        for col, x in get_edinet_list_columns().items():
+            df[x] = df[col].where(df[col].notnull(), None)
+        df.loc[:, 'ticker'] = df['証券コード'].str.slice(0, 4)
+        self.df = df
+        self.indexes = {}
+        return self
+
+    def get_positions(self, col:str):
+        """
+        value of col -> row position, the first row wins for duplicate values
+        """
+        return self.get_index(col, None)
+
+    def get_index(self, fromcol:str, tocol:str):
+        key = (fromcol, tocol)
+        with self.lock:
+            if key not in self.indexes:
+                keys = self.df[fromcol].to_numpy()
+                values = np.arange(len(keys)) if tocol is None else self.df[tocol].to_numpy()
+                index = {}
+                for k, v in zip(keys, values):
+                    if k is not None and k == k and k not in index:
+                        index[k] = v
+                self.indexes[key] = index
+        return self.indexes[key]
+
+    def get(self, value:str, fromcol:str, tocol:str):
+        return self.get_index(fromcol, tocol).get(value)
+
+    def lookup(self, values:pd.Series, fromcol:str, tocol:str):
+        """
+        vectorized get, NaN where the identifier is unknown
+        """
+        return values.map(self.get_index(fromcol, tocol))
+
+    def join(self, df:pd.DataFrame, on:str='ticker'):
+        """
+        left join of all code list columns onto df by an identifier column, without a merge
+        """
+        pos = df[on].map(self.get_positions(on))
+        found = pos.notnull().to_numpy()
+        pos = pos.fillna(0).astype(np.int64).to_numpy()
+        right = self.df.drop(columns=[on]).iloc[pos].reset_index(drop=True)
+        right = right.where(np.repeat(found[:, None], right.shape[1], axis=1))
+        right.index = df.index
+        return pd.concat([df, right], axis=1)
+
+    def get_df(self):
+        #the indexes point into self.df, it must not change under them
+        return self.df.copy()
+
+
+_MASTERS = {}
+_MASTERS_LOCK = threading.Lock()
+
+def get_security_master(asof=None, fdir=None, listed_only=True):
+    """
+    SecurityMaster of the snapshot valid at asof (default latest), loaded once per process
+    """
+    sm = SecurityMaster(asof=asof, fdir=fdir, listed_only=listed_only)
+    key = (sm.fn, listed_only)
+    with _MASTERS_LOCK:
+        if key not in _MASTERS:
+            _MASTERS[key] = sm.load()
+    return _MASTERS[key]
+
+def _get_security_master_or_none(asof=None):
+    try:
+        return get_security_master(asof=asof)
+    except FileNotFoundError:
+        return None
+
+def to_tickers(codes, asof=None):
+    """
+    4-digit tickers of a list of tickers, 5-digit secCodes or EDINET codes. Codes the
+    security master does not know (or all, without a snapshot) are returned unchanged.
+    """
+    codes = pd.Series([str(x) for x in codes], dtype=object)
+    secmaster = _get_security_master_or_none(asof)
+    if secmaster is None:
+        return codes.tolist()
+    tickers = secmaster.lookup(codes, 'secCode', 'ticker')
+    tickers = tickers.where(tickers.notnull(), secmaster.lookup(codes, 'edinetcode', 'ticker'))
+    return tickers.where(tickers.notnull(), codes).tolist()
+
+def get_issuer_codes(code:str, asof=None):
+    """
+    [ticker, secCode] of one issuer given either of them. Resolved through the security
+    master; the ticker + '0' convention is only used where it has no entry.
+    """
+    code = str(code)
+    codes = pd.Series([code], dtype=object)
+    ticker, seccode = (code, None) if len(code) == 4 else (None, code)
+    secmaster = _get_security_master_or_none(asof)
+    if secmaster is not None:
+        if ticker is None:
+            ticker = secmaster.lookup(codes, 'secCode', 'ticker').iloc[0]
+        else:
+            seccode = secmaster.lookup(codes, 'ticker', 'secCode').iloc[0]
+    if ticker is None or pd.isnull(ticker):
+        ticker = code[:4]
+    if seccode is None or pd.isnull(seccode):
+        seccode = code + '0'
+    return [ticker, seccode]
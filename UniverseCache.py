@@ -0,0 +1,94 @@
+import os
+import time
+import tempfile
+import threading
+import pandas as pd
+
+
+def get_cache_dir():
+    cachedir = os.environ.get('UNIVERSE_CACHE_DIR')
+    if cachedir is None:
+        cachedir = os.path.join(tempfile.gettempdir(), 'universe_cache')
+    return cachedir
+
+
+def to_seccode(codes:pd.Series):
+    """
+    4-digit TSE code (str, int or float as read from the weight files) -> 5-digit EDINET secCode
+    """
+    return codes.astype(str).str.replace(r'\.0$', '', regex=True) + '0'
+
+
+class UniverseCache:
+    """
+    Caches a universe file (e.g. the TOPIX weight file) in memory for ttl seconds,
+    backed by an on-disk snapshot keyed by download date:
+    {cachedir}/{name}/YYYYMMDD.pkl
+    get_seccodes() returns a prebuilt frozenset of secCode strings for isin filters.
+    """
+    def __init__(self, name:str, loader, codecol:str='コード', ttl:float=12*3600, cachedir=None):
+        self.name = name
+        self.loader = loader
+        self.codecol = codecol
+        self.ttl = ttl
+        if cachedir is None:
+            cachedir = get_cache_dir()
+        self.fdir = os.path.join(cachedir, name)
+        self.df = None
+        self.seccodes = None
+        self.loadedat = None
+        self.lock = threading.Lock()
+
+    def _snapshot_fn(self, dt:pd.Timestamp):
+        return os.path.join(self.fdir, dt.strftime('%Y%m%d') + '.pkl')
+
+    def _is_fresh(self):
+        return self.loadedat is not None and (time.time() - self.loadedat) < self.ttl
+
+    def _set(self, df, loadedat):
+        self.df = df
+        self.seccodes = frozenset(to_seccode(df[self.codecol]))
+        self.loadedat = loadedat
+
+    def load(self, force=False):
+        with self.lock:
+            if self._is_fresh() and not force:
+                return self
+            fn = self._snapshot_fn(pd.Timestamp.now())
+            if not force and os.path.exists(fn) and (time.time() - os.path.getmtime(fn)) < self.ttl:
+                self._set(pd.read_pickle(fn), os.path.getmtime(fn))
+                return self
+            df = self.loader()
+            os.makedirs(self.fdir, exist_ok=True)
+            df.to_pickle(fn)
+            self._set(df, time.time())
+        return self
+
+    def load_snapshot(self, dt:pd.Timestamp):
+        """
+        universe as downloaded on date dt, None if no snapshot was taken that day
+        """
+        fn = self._snapshot_fn(dt)
+        if not os.path.exists(fn):
+            return None
+        return pd.read_pickle(fn)
+
+    def get_df(self):
+        #callers tend to add columns, hand out a copy
+        return self.load().df.copy(deep=True)
+
+    def get_seccodes(self):
+        return self.load().seccodes
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+def get_universe_cache(name:str, loader, **kwargs):
+    """
+    one UniverseCache per name and process
+    """
+    with _CACHES_LOCK:
+        if name not in _CACHES:
+            _CACHES[name] = UniverseCache(name, loader, **kwargs)
+    return _CACHES[name]
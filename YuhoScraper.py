@@ -10,36 +10,150 @@ import pandas as pd
 import tqdm
 import os
 import re
+import queue
+import threading
+import SecurityMaster as sm
 
 
 def download_all_yuhos_by_edinetcode(ecode, code=None):
-    if code is None:
-        code = ecode
     with YuhoScraper() as ys:
-        ys.get_search_page_from_edinetcode(ecode)
-        ylinks = ys.get_yuho_links()
-        linktexts = [ylink.text for ylink in ylinks if ylink.text[0] == '有']
-        #skip the Teisei filings
-        mdf = []
-        for linktext in linktexts:
-            try:
-                ys.close_all_but_first_window()
-                ylink = ys.get_yuho_link_by_text(linktext)
-                idf = ys.get_metadata_for_ylink_as_dataframe(ylink)
-                ys.click_yuho_link(ylink)
-                ys.click_holdings_section()
-                fn = ['output', 'kaishajokyo',
-                      code + '_' + str(idf['filingdatetime'].dt.date.iloc[0])\
-                                    .replace('-', '')+'.html']
-                fn = os.path.join(*fn)
-                ys.save_content(fn)
-                ys.close_all_but_first_window()
-                idf.loc[:, 'status'] = 'SUCCESS'
-            except:
-                idf.loc[:, 'status'] = 'FAILED'
-            mdf.append(idf)
+        mdf = download_yuhos_with_scraper(ys, ecode, code)
+    return mdf
+
+def download_yuhos_with_scraper(ys, ecode, code=None):
+    """
+    Saves the holdings section of every yuho listed for ecode, using an already started
+    YuhoScraper, so that one browser can be reused across companies.
+    code (the prefix of the saved files) defaults to the ticker of ecode in the security master.
+    """
+    if code is None:
+        code = sm.to_tickers([ecode])[0]
+    ys.close_all_but_first_window()
+    ys.get_search_page_from_edinetcode(ecode)
+    ylinks = ys.get_yuho_links()
+    linktexts = [ylink.text for ylink in ylinks if ylink.text[0] == '有']
+    #skip the Teisei filings
+    mdf = []
+    for linktext in linktexts:
+        try:
+            ys.close_all_but_first_window()
+            ylink = ys.get_yuho_link_by_text(linktext)
+            idf = ys.get_metadata_for_ylink_as_dataframe(ylink)
+            ys.click_yuho_link(ylink)
+            ys.click_holdings_section()
+            fn = ['output', 'kaishajokyo',
+                  code + '_' + str(idf['filingdatetime'].dt.date.iloc[0])\
+                                .replace('-', '')+'.html']
+            fn = os.path.join(*fn)
+            ys.save_content(fn)
+            ys.close_all_but_first_window()
+            idf.loc[:, 'status'] = 'SUCCESS'
+        except:
+            idf.loc[:, 'status'] = 'FAILED'
+        mdf.append(idf)
     mdf = pd.concat(mdf)
     return mdf
+
+
+def get_scraper_pool_defaults():
+    #n_workers: number of long-lived browsers
+    #max_failures: consecutive failed companies after which a worker restarts its browser
+    #max_retries: attempts per edinetcode, a failed code goes back into the queue
+    #recycle_every: restart a browser after this many companies to keep its memory bounded
+    defaults = {'n_workers': 4,
+                'max_failures': 2,
+                'max_retries': 3,
+                'recycle_every': 200}
+    return defaults
+
+
+class YuhoScraperPool:
+    """
+    N worker threads, each owning one long-lived YuhoScraper, take edinetcodes from a
+    shared queue. A worker restarts its browser after max_failures consecutive failures
+    or every recycle_every companies; failed codes are retried up to max_retries times
+    by whichever worker is free.
+    pool = YuhoScraperPool().run(ecodes, codes)
+    pool.df holds the metadata of all filings, pool.failed the codes that never succeeded.
+    """
+    def __init__(self, config=None):
+        cfg = get_scraper_pool_defaults()
+        if config is not None:
+            cfg.update(config)
+        self.config = cfg
+        self.tasks = None
+        self.results = []
+        self.failed = []
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.pbar = None
+
+    def _start_scraper(self, ys=None):
+        if ys is not None:
+            try:
+                ys.__exit__(None, None, None)
+            except Exception:
+                pass
+        return YuhoScraper().__enter__()
+
+    def _worker(self, wid):
+        stats = {'done': 0, 'failed': 0, 'restarts': 0}
+        with self.lock:
+            self.stats[wid] = stats
+        ys = None
+        nfailures = 0
+        nsincestart = 0
+        while True:
+            try:
+                ecode, code, attempt = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if ys is None or nfailures >= self.config['max_failures'] or \
+                   nsincestart >= self.config['recycle_every']:
+                    if ys is not None:
+                        stats['restarts'] += 1
+                    ys = self._start_scraper(ys)
+                    nfailures = 0
+                    nsincestart = 0
+                nsincestart += 1
+                mdf = download_yuhos_with_scraper(ys, ecode, code)
+            except Exception as e:
+                nfailures += 1
+                stats['failed'] += 1
+                if attempt + 1 < self.config['max_retries']:
+                    self.tasks.put((ecode, code, attempt + 1))
+                else:
+                    print('We failed on edinetcode {ecode}: {e}'.format(ecode=ecode, e=e))
+                    with self.lock:
+                        self.failed.append(ecode)
+                        self.pbar.update(1)
+                continue
+            nfailures = 0
+            stats['done'] += 1
+            with self.lock:
+                self.results.append(mdf)
+                self.pbar.update(1)
+        if ys is not None:
+            ys.__exit__(None, None, None)
+
+    def run(self, ecodes, codes=None):
+        if codes is None:
+            codes = sm.to_tickers(ecodes)
+        self.tasks = queue.Queue()
+        for ecode, code in zip(ecodes, codes):
+            self.tasks.put((ecode, code, 0))
+        self.pbar = tqdm.tqdm(total=len(ecodes))
+        nworkers = min(self.config['n_workers'], max(1, len(ecodes)))
+        threads = [threading.Thread(target=self._worker, args=(wid,), daemon=True) for wid in range(nworkers)]
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+        self.pbar.close()
+        self.df = pd.concat(self.results) if self.results else pd.DataFrame()
+        return self
+
     
 class YuhoScraper:
 
@@ -171,7 +285,14 @@ class YuhoScraper:
 
 
 from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
 import pandas as pd
+import asyncio
+import requests
+import urllib.parse
+import lxml.html
+from requests.adapters import HTTPAdapter
+import UniverseCache as uc
 
 def run_for_topix():
     tpx = load_current_topix_file_from_tse()
@@ -180,14 +301,127 @@ def run_for_topix():
     return failedlist
 
 
-def load_current_topix_file_from_tse():
+def load_current_topix_file_from_tse(use_cache=True):
+    if use_cache:
+        cache = uc.get_universe_cache('tse_topixweight_j', _download_current_topix_file_from_tse,
+                                      codecol='code')
+        return cache.get_df()
+    return _download_current_topix_file_from_tse()
+
+def _download_current_topix_file_from_tse():
     tpxurl = 'https://www.jpx.co.jp/markets/indices/topix/tvdivq00000030ne-att/topixweight_j.csv'
     tpx = pd.read_csv(tpxurl, encoding='shift-jis').dropna(subset=['コード'])
     tpx.loc[:, 'code'] = tpx['コード'].astype(str).str.replace('.0', '', regex=False) 
     return tpx
 
-def get_sokai_meta_df(browser, code:str):
+def get_blocked_resource_types():
+    #the sokai flow needs the html and its scripts (changeTab), nothing else
+    return frozenset(['image', 'stylesheet', 'font', 'media'])
+
+def block_resources(page):
+    """
+    abort requests for images, css, fonts and media on a sync page or context
+    """
+    blocked = get_blocked_resource_types()
+    page.route('**/*', lambda route: route.abort() if route.request.resource_type in blocked
+                                     else route.continue_())
+    return page
+
+async def block_resources_async(page):
+    blocked = get_blocked_resource_types()
+    async def handler(route):
+        if route.request.resource_type in blocked:
+            await route.abort()
+        else:
+            await route.continue_()
+    await page.route('**/*', handler)
+    return page
+
+
+#connection pool shared by the per-lookup sessions of get_jpx_session
+_JPX_ADAPTER = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+
+def get_jpx_session():
+    """
+    New requests.Session for one lookup. The JPX search keeps its state in a server-side
+    session tied to the cookies, so concurrent lookups must not share a cookie jar;
+    only the connection pool is shared.
+    """
+    session = requests.Session()
+    session.mount('https://', _JPX_ADAPTER)
+    return session
+
+def _get_form_pairs(form, button=None, check=(), fields=None):
+    """
+    (name, value) pairs a browser would submit for form when clicking the submit input
+    whose value (or name) is button, with the checkboxes whose value is in check ticked
+    """
+    if fields is None:
+        fields = {}
+    pairs = []
+    for x in form.inputs:
+        name = x.get('name')
+        if not name or name in fields:
+            continue
+        if x.tag == 'select':
+            pairs.append((name, x.value or ''))
+            continue
+        typ = (x.get('type') or 'text').lower()
+        value = x.get('value', '')
+        if typ in ['checkbox', 'radio']:
+            if x.get('checked') is not None or value in check:
+                pairs.append((name, value or 'on'))
+        elif typ in ['submit', 'button', 'image']:
+            if button is not None and button in [value, name]:
+                pairs.append((name, value))
+        elif typ not in ['reset', 'file']:
+            pairs.append((name, value))
+    pairs.extend(fields.items())
+    return pairs
+
+def submit_form(session, rq, button=None, check=(), fields=None, timeout=30):
+    """
+    Replays the submit of the form in rq's page that holds button (or field name) over session.
+    """
+    doc = lxml.html.fromstring(rq.text, base_url=rq.url)
+    key = button if button is not None else list(fields.keys())[0]
+    forms = [x for x in doc.forms if x.xpath(".//input[@value=$v or @name=$v]", v=key)]
+    if len(forms) == 0:
+        raise ValueError('no form with {key} on {url}'.format(key=key, url=rq.url))
+    form = forms[0]
+    pairs = _get_form_pairs(form, button=button, check=check, fields=fields)
+    encoding = rq.encoding or 'utf-8'
+    data = urllib.parse.urlencode(pairs, encoding=encoding, errors='replace')
+    url = urllib.parse.urljoin(rq.url, form.get('action') or rq.url)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    if (form.get('method') or 'get').lower() == 'post':
+        res = session.post(url, data=data, headers=headers, timeout=timeout)
+    else:
+        res = session.get(url + '?' + data, timeout=timeout)
+    res.raise_for_status()
+    return res
+
+def get_sokai_meta_df_direct(code:str, session=None):
+    """
+    Same result as get_sokai_meta_df without a browser: the search form and the 基本情報 button
+    are replayed as form submits and the 縦覧書類 tab is read from the returned html
+    (the tabs are only hidden with css). Raises if the site answers with something else,
+    callers then fall back to the browser.
+    """
+    if session is None:
+        session = get_jpx_session()
+    url = 'https://www2.jpx.co.jp/tseHpFront/JJK010010Action.do?Show=Show'
+    rq = session.get(url, timeout=30)
+    rq.raise_for_status()
+    rq = submit_form(session, rq, button='searchButton', check=('011', '012', '013', 'RET'),
+                     fields={'eqMgrCd': code})
+    rq = submit_form(session, rq, button='基本情報')
+    return sokai_records_to_df(extract_sokai_records(rq.text, rq.url), code)
+
+def get_sokai_meta_df(browser, code:str, block=False):
     page = browser.new_page()
+    if block:
+        block_resources(page)
     url = 'https://www2.jpx.co.jp/tseHpFront/JJK010010Action.do?Show=Show'
     page.goto(url)
     page.click("input[value='011']")
@@ -198,47 +432,183 @@ def get_sokai_meta_df(browser, code:str):
     page.click("input[name='searchButton']")
     page.click("input[value='基本情報']")
     page.click("[href*=\"javascript:changeTab('4')\"]")
-    dfs = pd.read_html(page.content())
-    df = search_for_sokai(dfs)
-    ldf = extract_all_links(page)
-    df = df.merge(ldf, on='text', how='left')
-    df.loc[:, 'code'] = code
+    records = extract_sokai_records(page.content(), page.url)
     page.close()
-    return df
+    return sokai_records_to_df(records, code)
 
-def run_sokai_meta_downloads_for_codes(codes):
+def run_sokai_meta_downloads_for_codes(codes, mode='sync', outfn=None, config=None):
+    """
+    mode='async' runs the codes concurrently in one browser, see
+    run_sokai_meta_downloads_for_codes_async. It uses asyncio.run, which raises a
+    RuntimeError inside Jupyter (the loop is already running); in notebooks
+    await run_sokai_meta_downloads_for_codes_async(codes) directly.
+    Fast mode: config={'direct': True, 'block_resources': True} tries the direct form
+    posts first and loads pages without images/css/fonts when the browser is needed.
+    """
+    if mode == 'async':
+        return asyncio.run(run_sokai_meta_downloads_for_codes_async(codes, outfn, config))
+    #the TSE search takes tickers, secCodes and EDINET codes are resolved through the security master
+    codes = sm.to_tickers(codes)
+    cfg = get_sokai_async_defaults()
+    if config is not None:
+        cfg.update(config)
     idfs = []
     failedlist = []
     with sync_playwright() as p:
         browser = p.chromium.launch()
         for code in tqdm.tqdm(codes):
             try:
-                idf = get_sokai_meta_df(browser, code)
+                idf = None
+                if cfg['direct']:
+                    try:
+                        idf = get_sokai_meta_df_direct(code)
+                    except Exception:
+                        idf = None
+                if idf is None:
+                    idf = get_sokai_meta_df(browser, code, block=cfg['block_resources'])
                 idfs.append(idf)
             except:
                 print('We failed on code {code}.'.format(code=code))
                 failedlist.append(code)
     return pd.concat(idfs), failedlist
 
-def search_for_sokai(dfs):
-    searchstr = '総会'
-    for df in dfs:
-        for x in df.columns:
-            strcheck = (df.loc[:, x].astype(str).str.contains(searchstr) &\
-                        (~df.loc[:, x].astype(str).str.contains('予定'))).any()
-            if strcheck:
-                df.columns = ['date', 'text', 'blank_link', 'xbrl']
-                df.loc[:, 'date'] = pd.to_datetime(df['date'], errors='coerce')
-                df.loc[:, 'text'] = df.loc[:, 'text'].str.replace('\s+', '', regex=True)
-                return df
-            
-def extract_all_links(page):
-    hrefs_of_page = page.eval_on_selector_all("a[href^='/disc/']", "elements => elements.map(element => element.href)")
-    texts_of_page = page.eval_on_selector_all("a[href^='/disc/']", "elements => elements.map(element => element.text)")
-    ldf = pd.DataFrame([texts_of_page, hrefs_of_page]).T
-    ldf.columns = ['text', 'link']
-    ldf.loc[:, 'text'] = ldf.loc[:, 'text'].str.replace('\s+', '', regex=True)
-    return ldf
+def get_sokai_async_defaults():
+    #concurrency: lookups at the same time in the one browser, each in its own context
+    #max_retries: attempts per code
+    #backoff: seconds before the first retry, doubled for every further one
+    #direct: try get_sokai_meta_df_direct before opening a page
+    #block_resources: abort image/css/font/media requests of the pages
+    defaults = {'concurrency': 8,
+                'max_retries': 3,
+                'backoff': 2.0,
+                'direct': False,
+                'block_resources': False}
+    return defaults
+
+async def get_sokai_meta_df_async(context, code:str):
+    page = await context.new_page()
+    try:
+        url = 'https://www2.jpx.co.jp/tseHpFront/JJK010010Action.do?Show=Show'
+        await page.goto(url)
+        await page.click("input[value='011']")
+        await page.click("input[value='012']")
+        await page.click("input[value='013']")
+        await page.click("input[value='RET']")
+        await page.locator("input[name='eqMgrCd']").fill(code)
+        await page.click("input[name='searchButton']")
+        await page.click("input[value='基本情報']")
+        await page.click("[href*=\"javascript:changeTab('4')\"]")
+        html = await page.content()
+        url = page.url
+    finally:
+        await page.close()
+    #parsing is cpu bound, keep it off the event loop
+    records = await asyncio.to_thread(extract_sokai_records, html, url)
+    return sokai_records_to_df(records, code)
+
+async def run_sokai_meta_downloads_for_codes_async(codes, outfn=None, config=None):
+    """
+    Runs up to config['concurrency'] codes at a time in one browser. Every concurrent
+    lookup gets its own browser context, the JPX search keeps state in a server-side
+    session tied to the cookies, so lookups must not share them.
+    In Jupyter call it with await, asyncio.run fails inside a running event loop.
+    Failed codes are retried with exponential backoff; codes that fail max_retries
+    times end up in failedlist. With outfn, each code's rows are appended to that csv
+    as soon as it finishes, and codes already in outfn are skipped, so an interrupted
+    sweep resumes where it stopped.
+    """
+    cfg = get_sokai_async_defaults()
+    if config is not None:
+        cfg.update(config)
+    idfs = []
+    failedlist = []
+    codes = sm.to_tickers(codes)
+    if outfn is not None and os.path.exists(outfn):
+        done = set(pd.read_csv(outfn, usecols=['code'], dtype=str)['code'])
+        codes = [x for x in codes if str(x) not in done]
+    async with async_playwright() as p:
+        browser = await p.chromium.launch()
+        #a context is handed to one lookup at a time, the queue also limits the concurrency
+        contexts = asyncio.Queue()
+        for _ in range(max(1, min(cfg['concurrency'], len(codes)))):
+            context = await browser.new_context()
+            if cfg['block_resources']:
+                await block_resources_async(context)
+            contexts.put_nowait(context)
+
+        async def run_code(code):
+            context = await contexts.get()
+            try:
+                for attempt in range(cfg['max_retries']):
+                    if cfg['direct']:
+                        try:
+                            return code, await asyncio.to_thread(get_sokai_meta_df_direct, code)
+                        except Exception:
+                            pass
+                    try:
+                        return code, await get_sokai_meta_df_async(context, code)
+                    except Exception:
+                        if attempt + 1 < cfg['max_retries']:
+                            await asyncio.sleep(cfg['backoff'] * 2**attempt)
+            finally:
+                contexts.put_nowait(context)
+            return code, None
+
+        pbar = tqdm.tqdm(total=len(codes))
+        for fut in asyncio.as_completed([run_code(x) for x in codes]):
+            code, idf = await fut
+            pbar.update(1)
+            if idf is None:
+                print('We failed on code {code}.'.format(code=code))
+                failedlist.append(code)
+                continue
+            idfs.append(idf)
+            if outfn is not None:
+                idf.to_csv(outfn, mode='a', header=not os.path.exists(outfn), index=False)
+        pbar.close()
+        await browser.close()
+    df = pd.concat(idfs) if idfs else pd.DataFrame()
+    return df, failedlist
+
+def extract_sokai_records(html:str, baseurl:str):
+    """
+    Single lxml pass over the company detail page. Finds the innermost table with a
+    総会 row that is not 予定 (the 縦覧書類 tab) and returns one record per row:
+    date, text, blank_link, xbrl and the /disc/ link of the row.
+    None if there is no such table.
+    """
+    doc = lxml.html.fromstring(html, base_url=baseurl)
+    for table in doc.iter('table'):
+        if len(table.xpath('.//table')) > 0:
+            continue
+        records = []
+        found = False
+        for tr in table.xpath('./tr|./tbody/tr'):
+            #whitespace runs collapse to one space like in read_html, e.g. 'YYYY/MM/DD HH:MM'
+            cells = [re.sub(r'\s+', ' ', x.text_content()).strip() for x in tr.xpath('./td')]
+            if len(cells) < 2:
+                continue
+            #only the title loses all whitespace, as before
+            cells[1] = re.sub(r'\s+', '', cells[1])
+            found |= any(['総会' in x and '予定' not in x for x in cells])
+            cells = (cells + ['', ''])[:4]
+            hrefs = tr.xpath(".//a[starts-with(@href, '/disc/')]/@href")
+            records.append({'date': cells[0],
+                            'text': cells[1],
+                            'blank_link': cells[2] or None,
+                            'xbrl': cells[3] or None,
+                            'link': urllib.parse.urljoin(baseurl, hrefs[0]) if hrefs else None})
+        if found:
+            return records
+    return None
+
+def sokai_records_to_df(records, code:str):
+    if records is None:
+        raise ValueError('no sokai table for code {code}'.format(code=code))
+    df = pd.DataFrame(records, columns=['date', 'text', 'blank_link', 'xbrl', 'link'])
+    df['date'] = pd.to_datetime(df['date'], errors='coerce')
+    df.loc[:, 'code'] = code
+    return df
 
 class SokaiScraper:
 
@@ -0,0 +1,290 @@
+"""
+Benchmark for the large-holder (350) parse pipeline on synthetic data.
+
+Generates a day of EDINET lvh csv zips (UTF-16 TSV in the real 要素ID/コンテキストID shape)
+into a local directory laid out like the bucket, points the storage backend at it
+(storage.LocalStorage) and times every stage of run_parser_for_date. One json line per stage is
+written, so runs from different commits can be compared with compare_runs.
+Wall time and peak RSS come from an untraced pass; tracemalloc slows pandas down severalfold,
+so peak traced allocations are measured in a second pass (skip it with --no-trace).
+
+python bench_largeholders.py --filings 500 --holders 1,1,1,2,3,5 --out bench_output.txt
+python bench_largeholders.py --compare old.txt new.txt
+"""
+import os
+import sys
+import json
+import time
+import zipfile
+import argparse
+import platform
+import threading
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+import edinet
+import storage
+
+
+def get_element_names():
+    """
+    snake_case names (as produced by the parser) of the elements in a synthetic filing
+    """
+    dei = ['edinet_code_dei', 'filer_name_in_english_dei', 'filer_name_in_japanese_dei',
+           'security_code_dei', 'document_type_dei', 'number_of_submission_dei']
+    issuer = ['arrangement_of_filing_cover_page', 'clause_of_stipulation_cover_page',
+              'date_when_filing_requirement_arose_cover_page', 'document_title_cover_page',
+              'filing_date_cover_page', 'listed_or_o_t_c', 'name_cover_page', 'name_of_issuer',
+              'place_of_filing_cover_page', 'reason_for_filing_change_report_cover_page',
+              'reason_for_filing_change_report_cover_page_na',
+              'residential_address_or_address_of_registered_headquarter_cover_page',
+              'security_code_of_issuer', 'stock_listing',
+              'total_number_of_filers_and_joint_holders_cover_page']
+    common = ['base_date', 'holding_ratio_of_share_certificates_etc',
+              'holding_ratio_of_share_certificates_etc_per_last_report',
+              'notes_holding_ratio_of_share_certificates_etc_text_block',
+              'notes_number_of_stocks_etc_held_text_block', 'number_of_residual_stocks_held',
+              'number_of_stocks_etc_to_deduct_as_rights_to_demand_exist_between_joint_holders',
+              'number_of_stocks_etc_to_deduct_as_sold_on_margin_trading',
+              'total_number_of_outstanding_stocks_etc', 'total_number_of_stocks_etc_held']
+    for sec in ['convertible_bonds', 'exchangeable_bonds', 'stock_depository_receipts',
+                'stock_related_depository_receipts', 'stock_related_trust_beneficiary_rights',
+                'stock_trust_beneficiary_rights', 'stocks_or_investment_securities_etc',
+                'subscription_rights_to_shares', 'target_security_covered_warrants',
+                'target_security_redeemable_bonds', 'total']:
+        for clause in ['item1', 'item2', 'main_clause']:
+            common.append(sec + '_article27233_' + clause)
+    special = ['purpose_of_holding', 'act_of_making_important_proposal_etc',
+               'act_of_making_important_proposal_etc_na',
+               'significant_contracts_related_to_said_stocks_etc_such_as_collateral_agreements_na',
+               'significant_contracts_related_to_said_stocks_etc_such_as_collateral_agreements_text_block']
+    amount = ['total_amount_from_other_sources', 'total_amount_of_funding_for_acquisition']
+    return dei, issuer, common, special, amount
+
+
+def to_element_id(name:str, prefix:str):
+    #inverse of ElementIdNormalizer: 'name_of_issuer' -> 'jplvh_cor:NameOfIssuer'
+    return prefix + ':' + ''.join([x.capitalize() for x in name.split('_')])
+
+
+def make_filing(i:int, nholders:int, textsize:int, rng):
+    """
+    one synthetic lvh csv as a DataFrame with the columns of the EDINET csv
+    """
+    dei, issuer, common, special, amount = get_element_names()
+    ctx0 = 'FilingDateInstant'
+    rows = []
+    for x in dei:
+        val = 'E{i:05d}'.format(i=i % 3000) if x == 'edinet_code_dei' else '{x}_{k}'.format(x=x, k=i % 7)
+        rows.append((to_element_id(x, 'jpdei_cor'), ctx0, val))
+    for x in issuer:
+        if x == 'total_number_of_filers_and_joint_holders_cover_page':
+            val = str(nholders)
+        elif x == 'security_code_of_issuer':
+            val = '{code}0'.format(code=1300 + i % 2000)
+        else:
+            val = '{x}_{k}'.format(x=x, k=i % 5)
+        rows.append((to_element_id(x, 'jplvh_cor'), ctx0, val))
+    for x in common:
+        rows.append((to_element_id(x, 'jplvh_cor'), ctx0, str(rng.integers(0, 10**8))))
+    for h in range(1, nholders + 1):
+        ctx = 'FilerLargeVolumeHolder{h}Member'.format(h=h)
+        for x in common + special:
+            if x.endswith('text_block') or x.startswith('purpose'):
+                val = ('保有目的{k}。'.format(k=rng.integers(0, 5))) * max(1, textsize // 6)
+            else:
+                val = str(rng.integers(0, 10**8))
+            rows.append((to_element_id(x, 'jplvh_cor'), ctx, val))
+        for x in amount:
+            rows.append((to_element_id(x, 'jplvh_cor'), ctx, str(rng.integers(0, 10**9))))
+    df = pd.DataFrame(rows, columns=['要素ID', 'コンテキストID', '値'])
+    df.insert(1, '項目名', df['要素ID'].str.split(':').str.get(-1))
+    df.insert(3, '相対年度', '提出日時点')
+    df.insert(4, '連結・個別', 'その他')
+    df.insert(5, '期間・時点', '時点')
+    df.insert(6, 'ユニットID', '')
+    df.insert(7, '単位', '')
+    return df
+
+
+def generate_day(rootdir:str, dt:pd.Timestamp, nfilings:int=200, holders=(1, 1, 1, 2, 3), textsize:int=200, seed:int=0):
+    """
+    writes {rootdir}/edinet/tairyohoyu/YYYYMMDD/meta.csv.gz and csv/<docID>.csv.zip
+    """
+    rng = np.random.default_rng(seed)
+    basedir = os.path.join(rootdir, 'edinet', 'tairyohoyu', dt.strftime('%Y%m%d'))
+    os.makedirs(os.path.join(basedir, 'csv'), exist_ok=True)
+    docIDs = ['S1{i:06d}'.format(i=i) for i in range(nfilings)]
+    nrows = 0
+    for i, docID in enumerate(docIDs):
+        df = make_filing(i, int(rng.choice(holders)), textsize, rng)
+        nrows += df.shape[0]
+        txt = df.to_csv(sep='\t', index=False)
+        fn = os.path.join(basedir, 'csv', docID + '.csv.zip')
+        with zipfile.ZipFile(fn, 'w', zipfile.ZIP_DEFLATED) as zfil:
+            zfil.writestr('XBRL_TO_CSV/jplvh010000-lvh-001_{docID}.csv'.format(docID=docID), txt.encode('utf-16'))
+    meta = pd.DataFrame({'docID': docIDs, 'docTypeCode': '350', 'downloaded': True})
+    meta.to_csv(os.path.join(basedir, 'meta.csv.gz'), index=False)
+    return nrows
+
+
+def _rss():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class StageTimer:
+    """
+    Context manager measuring wall time and peak RSS (sampled every 5ms on a background
+    thread) of one stage, with trace=True also peak traced allocations. Traced wall times
+    are not comparable to untraced ones.
+    """
+    def __init__(self, name, trace=False):
+        self.name = name
+        self.trace = trace
+        self.result = None
+
+    def _sample(self):
+        while not self.stopped.is_set():
+            rss = _rss()
+            if rss is not None:
+                self.peakrss = max(self.peakrss, rss)
+            self.stopped.wait(0.005)
+
+    def __enter__(self):
+        self.peakrss = _rss() or 0
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+        if self.trace:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        wall = time.perf_counter() - self.start
+        peaktraced = None
+        if self.trace:
+            _, peaktraced = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        self.stopped.set()
+        self.sampler.join()
+        self.result = {'stage': self.name,
+                       'wall_s': round(wall, 4),
+                       'peak_traced_mb': round(peaktraced / 2**20, 2) if peaktraced is not None else None,
+                       'peak_rss_mb': round(self.peakrss / 2**20, 2) if self.peakrss else None}
+
+
+def get_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_stages(dt:pd.Timestamp, trace=False):
+    """
+    runs the pipeline of one day stage by stage, returns the StageTimer results and rows out
+    """
+    #prepare_for_parse reads the csvs chunk by chunk itself, like in run_parser_for_date
+    stages = [('load_files_and_meta_data', lambda p: p.load_files_and_meta_data(), lambda p: p.meta.shape[0]),
+              ('prepare_for_parse', lambda p: p.prepare_for_parse(), lambda p: p.kdfl.shape[0]),
+              ('parse_full_summary_table', lambda p: p.parse_full_summary_table(), lambda p: p.sumrytbl.shape[0])]
+    plh = edinet.ParseLargeHolders(dt)
+    results = []
+    for name, fun, rowsout in stages:
+        with StageTimer(name, trace=trace) as timer:
+            plh = fun(plh)
+        results.append((timer.result, rowsout(plh)))
+    return results
+
+
+def run_benchmark(workdir:str, nfilings:int=200, holders=(1, 1, 1, 2, 3), textsize:int=200, seed:int=0, trace=True):
+    """
+    Returns one dict per stage: wall time, peak memory, rows out and raw csv rows/sec.
+    Timings come from an untraced pass, peak_traced_mb from a second traced pass if trace.
+    """
+    dt = pd.Timestamp('2024-06-03')
+    os.environ.setdefault('BUCKETNAME', 'bench')
+    nrows = generate_day(workdir, dt, nfilings=nfilings, holders=holders, textsize=textsize, seed=seed)
+    storage.set_storage(storage.LocalStorage(workdir))
+    common = {'commit': get_commit(),
+              'filings': nfilings,
+              'holders': ','.join([str(x) for x in holders]),
+              'textsize': textsize,
+              'seed': seed,
+              'python': platform.python_version(),
+              'pandas': pd.__version__}
+    timed = run_stages(dt)
+    traced = run_stages(dt, trace=True) if trace else [(None, None)] * len(timed)
+    results = []
+    for (timing, rowsout), (tracing, _) in zip(timed, traced):
+        res = dict(common)
+        res.update(timing)
+        if tracing is not None:
+            res['peak_traced_mb'] = tracing['peak_traced_mb']
+        #throughput is always measured in raw csv rows of the day
+        res['rows_in'] = nrows
+        res['rows_out'] = rowsout
+        res['rows_per_s'] = round(nrows / timing['wall_s'], 1) if timing['wall_s'] > 0 else None
+        results.append(res)
+    return results
+
+
+def compare_runs(basefn:str, newfn:str):
+    """
+    per stage ratio new/base of wall time and peak memory of two benchmark outputs
+    """
+    base = pd.read_json(basefn, lines=True).groupby('stage').median(numeric_only=True)
+    new = pd.read_json(newfn, lines=True).groupby('stage').median(numeric_only=True)
+    cols = ['wall_s', 'peak_traced_mb', 'peak_rss_mb']
+    df = (new.loc[:, cols] / base.loc[:, cols]).add_suffix('_ratio')
+    return pd.concat([base.loc[:, ['wall_s']].add_prefix('base_'), new.loc[:, ['wall_s']].add_prefix('new_'), df], axis=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the large-holder parse pipeline on synthetic filings.')
+    parser.add_argument('--filings', type=int, default=200, help='filings per day')
+    parser.add_argument('--holders', default='1,1,1,2,3', help='joint holder counts, sampled uniformly per filing')
+    parser.add_argument('--textsize', type=int, default=200, help='characters per text block')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-trace', action='store_true', help='skip the tracemalloc pass, peak_traced_mb is left empty')
+    parser.add_argument('--workdir', default=None, help='where the synthetic bucket goes, default a temp dir')
+    parser.add_argument('--out', default=None, help='append json lines here instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two outputs and exit')
+    args = parser.parse_args(argv)
+    if args.compare:
+        print(compare_runs(*args.compare).to_string())
+        return
+    import tempfile
+    holders = tuple([int(x) for x in args.holders.split(',')])
+    out = open(args.out, 'a') if args.out else sys.stdout
+    try:
+        for i in range(args.repeat):
+            with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+                for res in run_benchmark(workdir, nfilings=args.filings, holders=holders,
+                                         textsize=args.textsize, seed=args.seed, trace=not args.no_trace):
+                    res['run'] = i
+                    out.write(json.dumps(res, ensure_ascii=False) + '\n')
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
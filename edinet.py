@@ -1,15 +1,24 @@
 import pandas as pd
+import numpy as np
 import requests
 import json
-#from mfs import gcs_utils as gc
-import gcs_utils as gc
+import storage as st
 import io
 import os
 from tqdm import tqdm
 from openai import OpenAI
 import io
 import tsetools as tt
+import UniverseCache as uc
+import ResponseCache as rc
+import SecurityMaster as sm
 import time
+import re
+import hashlib
+import threading
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 def get_doccodes():
     doccodes = {350: 'tairyohoyu',
@@ -20,12 +29,282 @@ def get_doccodes():
                 }
     return doccodes
 
-def get_contenttypes():
+def get_contenttypes(typenumbs=None):
+    """
+    EDINET document types: 1 full XBRL zip, 2 pdf, 5 csv zip.
+    typenumbs restricts the dict to the types a pipeline consumes, see get_pipeline_config.
+    """
     docdict = {'1':['application/zip', 'zip'],
                 '2':['application/pdf', 'pdf'],
                 '5':['application/zip', 'csv.zip']}
+    if typenumbs is not None:
+        docdict = {k: v for k, v in docdict.items() if k in typenumbs}
     return docdict
 
+def get_availability_flags():
+    #meta column flagging whether EDINET has the type at all, types without one are always fetched
+    return {'2': 'pdfFlag', '5': 'csvFlag'}
+
+def get_download_defaults():
+    #max_workers: number of EDINET API requests in flight
+    #requests_per_second: sustained request rate shared by all workers of the process
+    defaults = {'max_workers': 4,
+                'requests_per_second': 2.0,
+                'timeout': 60,
+                'skip_stored': True}
+    #skip_stored: compare Content-Length with the stored blob and skip the body if equal
+    return defaults
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Tokens are refilled at rate per second
+    up to capacity; acquire() blocks until a token is available.
+    """
+    def __init__(self, rate:float, capacity:float=None):
+        self.rate = rate
+        if capacity is None:
+            capacity = max(1.0, rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens:float=1.0):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_SESSION = None
+_LIMITERS = {}
+_HTTP_LOCK = threading.Lock()
+
+def get_session(poolsize:int=16):
+    """
+    One pooled requests.Session per process, shared by all downloaders.
+    """
+    global _SESSION
+    with _HTTP_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=poolsize, pool_maxsize=poolsize)
+            session.mount('https://', adapter)
+            _SESSION = session
+    return _SESSION
+
+def get_rate_limiter(rate:float=None):
+    """
+    Rate limiters are shared per rate, so that concurrent processors in the same
+    process stay within the allowed EDINET request rate together.
+    """
+    if rate is None:
+        rate = get_download_defaults()['requests_per_second']
+    with _HTTP_LOCK:
+        if rate not in _LIMITERS:
+            _LIMITERS[rate] = TokenBucket(rate)
+    return _LIMITERS[rate]
+
+def edinet_get(url:str, config=None, stream:bool=False):
+    """
+    Rate-limited GET over the pooled session. Retries once on a reset connection.
+    With stream=True only the headers are read, the body is left to rq.raw.
+    Raises requests.HTTPError on anything but a 200, see check_response.
+    """
+    if config is None:
+        config = {}
+    defaults = get_download_defaults()
+    limiter = get_rate_limiter(config.get('requests_per_second', defaults['requests_per_second']))
+    session = get_session()
+    timeout = config.get('timeout', defaults['timeout'])
+    limiter.acquire()
+    try:
+        rq = session.get(url, timeout=timeout, stream=stream)
+    except (ConnectionResetError, requests.exceptions.ConnectionError):
+        limiter.acquire()
+        rq = session.get(url, timeout=timeout, stream=stream)
+    return check_response(rq)
+
+def check_response(rq, document:bool=False):
+    """
+    Raises requests.HTTPError for error answers, so they never end up in storage as a document.
+    The document endpoint (document=True) also answers a missing docID/type or throttling
+    with a json body instead of the binary. The url is left out, it holds the subscription key.
+    """
+    error = rq.status_code != 200
+    error |= document and rq.headers.get('Content-Type', '').startswith('application/json')
+    if error:
+        msg = 'EDINET answered {status} {reason}: {body}'.format(status=rq.status_code, reason=rq.reason,
+                                                                  body=rq.text[:200])
+        rq.close()
+        raise requests.HTTPError(msg, response=rq)
+    return rq
+
+def _is_cacheable(rq, cachekey):
+    if rq.status_code != 200:
+        return False
+    if cachekey[0] == 'documents.json':
+        return str(json.loads(rq.content).get('metadata', {}).get('status')) == '200'
+    #document endpoints answer errors with a json body instead of the binary
+    return not rq.headers.get('Content-Type', '').startswith('application/json')
+
+def edinet_get_cached(url:str, cachekey:tuple, config=None, ttl:float=None, final_after:float=None):
+    """
+    edinet_get through the response cache (see ResponseCache.get_response_cache), returns the body.
+    cachekey is (endpoint, date or docID, type); only successful responses are stored.
+    ttl and final_after as in ResponseCache.get.
+    """
+    cache = rc.get_response_cache(config)
+    if cache is not None:
+        content = cache.get(*cachekey, ttl=ttl, final_after=final_after)
+        if content is not None:
+            return content
+    rq = edinet_get(url, config)
+    if cache is not None and _is_cacheable(rq, cachekey):
+        cache.put(*cachekey, rq.content)
+    return rq.content
+
+
+def get_ledger_defaults():
+    #flush_every: flush completion records to the bucket every K docIDs
+    #flush_seconds: ... or every T seconds, whichever comes first
+    #ledgerdir: local directory for the journal files
+    defaults = {'flush_every': 25,
+                'flush_seconds': 60,
+                'ledgerdir': os.path.join(tempfile.gettempdir(), 'edinet_ledger')}
+    return defaults
+
+
+class DownloadLedger:
+    """
+    Append-only download ledger for one basedir, e.g. edinet/tairyohoyu/YYYYMMDD.
+    Each completed docID is appended to a local journal and collected into small
+    segment files flushed to {basedir}/ledger/ every flush_every docIDs or
+    flush_seconds. compact() merges all completions into meta.csv.gz and deletes
+    the merged segments, so the ledger directory does not grow with every rerun.
+    A resumed run reads meta.csv.gz plus the segments (plus a leftover local
+    journal), so a day with N filings costs O(N) instead of O(N^2).
+    """
+    def __init__(self, basedir:str, meta:pd.DataFrame, config=None):
+        if config is None:
+            config = {}
+        defaults = get_ledger_defaults()
+        self.basedir = basedir
+        self.metafn = basedir + '/meta.csv'
+        self.segmentdir = basedir + '/ledger'
+        self.meta = meta
+        self.storage = config.get('storage') or st.get_storage()
+        self.flush_every = config.get('flush_every', defaults['flush_every'])
+        self.flush_seconds = config.get('flush_seconds', defaults['flush_seconds'])
+        localdir = os.path.join(config.get('ledgerdir', defaults['ledgerdir']), *basedir.split('/'))
+        os.makedirs(localdir, exist_ok=True)
+        self.journalfn = os.path.join(localdir, 'journal.csv')
+        self.runid = pd.Timestamp.now().strftime('%Y%m%d%H%M%S%f')
+        self.seq = 0
+        self.done = set()
+        self.metadone = None
+        self.metadocIDs = None
+        self.segments = []
+        self.unflushed = []
+        self.lastflush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _read_meta_flags(self):
+        try:
+            curmeta = self.storage.read_csv(self.metafn + '.gz')
+        except FileNotFoundError:
+            return None
+        curmeta = curmeta.reindex(columns=['docID', 'downloaded'])
+        curmeta.loc[:, 'downloaded'] = curmeta['downloaded'].fillna(False).astype(bool)
+        self.metadocIDs = set(curmeta['docID'])
+        return set(curmeta.loc[curmeta['downloaded'], 'docID'])
+
+    def _read_segments(self):
+        done = set()
+        for blob in self.storage.listdir(self.segmentdir + '/'):
+            done.update(self.storage.read_csv(blob.name)['docID'])
+            self.segments.append(blob.name)
+        return done
+
+    def _read_journal(self):
+        if not os.path.exists(self.journalfn):
+            return set()
+        with open(self.journalfn, 'r') as f:
+            return set([x.strip() for x in f if x.strip()])
+
+    def load(self):
+        flags = self._read_meta_flags()
+        if flags is None:
+            #first run for this date, persist the listing right away
+            imeta = self.meta.copy(deep=True)
+            imeta.loc[:, 'downloaded'] = False
+            self.storage.save_df(imeta, self.metafn)
+            self.metadocIDs = set(imeta['docID'])
+            flags = set()
+        self.metadone = flags
+        self.done = flags | self._read_segments() | self._read_journal()
+        return self
+
+    def pending(self):
+        return [x for x in self.meta['docID'] if x not in self.done]
+
+    def record(self, docID:str):
+        with self.lock:
+            with open(self.journalfn, 'a') as f:
+                f.write(docID + '\n')
+            self.done.add(docID)
+            self.unflushed.append(docID)
+            due = len(self.unflushed) >= self.flush_every
+            due |= (time.monotonic() - self.lastflush) >= self.flush_seconds
+            if due:
+                self._flush()
+        return self
+
+    def _flush(self):
+        if self.unflushed:
+            segfn = self.segmentdir + '/{runid}_{seq:05d}.csv'.format(runid=self.runid, seq=self.seq)
+            seg = pd.DataFrame(self.unflushed, columns=['docID'])
+            self.storage.save_df(seg, segfn)
+            self.segments.append(segfn + '.gz')
+            self.seq += 1
+            self.unflushed = []
+        self.lastflush = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+        return self
+
+    def compact(self):
+        """
+        Merge all completion records into meta.csv.gz, then delete the merged segments
+        and the local journal. meta.csv.gz is only rewritten if a flag or the listing changed.
+        """
+        with self.lock:
+            self._flush()
+            docIDs = set(self.meta['docID'])
+            done = docIDs & self.done
+            if done != (self.metadone & docIDs) or docIDs != self.metadocIDs:
+                imeta = self.meta.copy(deep=True)
+                imeta.loc[:, 'downloaded'] = imeta['docID'].isin(self.done)
+                self.storage.save_df(imeta, self.metafn)
+                self.metadone = done
+                self.metadocIDs = docIDs
+            #meta.csv.gz holds every record of these segments now
+            for segfn in self.segments:
+                self.storage.delete(segfn)
+            self.segments = []
+            if os.path.exists(self.journalfn):
+                os.remove(self.journalfn)
+        return self
+
 
 class MetaDataProcessor:
     """
@@ -57,9 +336,16 @@ class MetaDataProcessor:
     
     def read_all_meta_data(self):
         dt = self.date
+        dtstr = dt.strftime('%Y-%m-%d')
         url = 'https://api.edinet-fsa.go.jp/api/v2/documents.json?date={dtstr}&type=2&Subscription-Key={skey}'
-        rq = requests.get(url.format(dtstr=dt.strftime('%Y-%m-%d'), skey=os.environ['EDINETKEY']))
-        jdict = json.loads(rq.content)
+        #a listing is final once fetched after the end of its day (JST); one fetched while
+        #the day was still being filed expires after today_ttl, also when read days later
+        ttl = self.config.get('http_cache_today_ttl', rc.get_response_cache_defaults()['today_ttl'])
+        dayend = pd.Timestamp(dt.strftime('%Y-%m-%d'), tz='Asia/Tokyo') + pd.Timedelta(days=1)
+        content = edinet_get_cached(url.format(dtstr=dtstr, skey=os.environ['EDINETKEY']),
+                                    ('documents.json', dtstr, '2'), self.config, ttl=ttl,
+                                    final_after=dayend.timestamp())
+        jdict = json.loads(content)
         self.meta = pd.json_normalize(jdict['results'])
         return self
     
@@ -77,58 +363,114 @@ class MetaDataProcessor:
             self.meta = self.config['filterfun'](self.meta)
         return self
 
-    def _download_all_types_for_docID(self, docID):
-        dtstr = self.date.strftime('%Y%m%d')
-        print(self.config['docdict'])
-        for typenumb, ext in self.config['docdict'].items():
+    def get_blob_name(self, docID:str, typenumb:str):
+        ext = get_contenttypes()[typenumb]
+        fext = ext[1].split('.')[0]
+        fullext = ext[1]
+        #full fn will look like this: 'edinet/{doctypename}/{dtstr}'/{fext}/{docID}.{fullext}'
+        return self.basedir + f'/{fext}/{docID}.{fullext}'
+
+    def _download_type_for_docID(self, docID:str, typenumb:str):
+        """
+        Streams one type of docID from EDINET into storage chunk by chunk, teeing it into the
+        response cache if one is configured. Returns the blob name.
+        """
+        contenttype = get_contenttypes()[typenumb][0]
+        fname = self.get_blob_name(docID, typenumb)
+        storage = self.config.get('storage') or st.get_storage()
+        cachekey = ('documents', docID, typenumb)
+        cache = rc.get_response_cache(self.config)
+        if cache is not None:
+            content = cache.get(*cachekey)
+            if content is not None:
+                storage.save_stream(io.BytesIO(content), fname, contenttype=contenttype, size=len(content))
+                return fname
+        url = 'https://api.edinet-fsa.go.jp/api/v2/documents/{docID}?type={typenumb}&Subscription-Key={skey}'
+        rq = edinet_get(url.format(docID=docID, skey=os.environ['EDINETKEY'], typenumb=typenumb),
+                        self.config, stream=True)
+        check_response(rq, document=True)
+        try:
+            #Content-Length is the stored size unless the body is compressed in transit
+            size = rq.headers.get('Content-Length')
+            size = int(size) if size is not None and 'Content-Encoding' not in rq.headers else None
+            skip = self.config.get('skip_stored', get_download_defaults()['skip_stored'])
+            if skip and size is not None:
+                if storage.size(fname) == size:
+                    #stored by an earlier run whose ledger record got lost, leave the body unread
+                    return fname
+            rq.raw.decode_content = True
+            strm = rq.raw
+            if cache is not None and _is_cacheable(rq, cachekey):
+                strm = cache.tee(rq.raw, *cachekey, size=size)
             try:
-                url = 'https://api.edinet-fsa.go.jp/api/v2/documents/{docID}?type={typenumb}&Subscription-Key={skey}'
-                rq = requests.get(url.format(docID=docID, skey=os.environ['EDINETKEY'], typenumb=typenumb))
-                fext = ext[1].split('.')[0]
-                fullext = ext[1]
-                #full fn will look like this: 'edinet/{doctypename}/{dtstr}'/{fext}/{docID}.{fullext}'
-                fname = self.basedir + f'/{fext}/{docID}.{fullext}'
-                strm = io.BytesIO(rq.content)
-                gc.save_stream_in_cloud(strm, os.environ['BUCKETNAME'], fname, contenttype=ext[0])
-            except ConnectionResetError:
-                url = 'https://api.edinet-fsa.go.jp/api/v2/documents/{docID}?type={typenumb}&Subscription-Key={skey}'
-                rq = requests.get(url.format(docID=docID, skey=os.environ['EDINETKEY'], typenumb=typenumb))
-                fext = ext[1].split('.')[0]
-                fullext = ext[1]
-                #full fn will look like this: 'edinet/{doctypename}/{dtstr}'/{fext}/{docID}.{fullext}'
-                fname = self.basedir + f'/{fext}/{docID}.{fullext}'
-                strm = io.BytesIO(rq.content)
-                gc.save_stream_in_cloud(strm, os.environ['BUCKETNAME'], fname, contenttype=ext[0])
-                
+                storage.save_stream(strm, fname, contenttype=contenttype, size=size)
+            finally:
+                if strm is not rq.raw:
+                    strm.close()
+        finally:
+            rq.close()
+        return fname
+
+    def _download_all_types_for_docID(self, docID):
+        #called from worker threads: every request goes through the shared session
+        #and the shared rate limiter, see edinet_get
+        available = getattr(self, 'available', {}).get(docID)
+        for typenumb in self.config['docdict'].keys():
+            if available is not None and typenumb not in available:
+                continue
+            self._download_type_for_docID(docID, typenumb)
+        return docID
+
+    def _set_available_types(self):
+        """
+        docID -> types EDINET actually has, from the pdfFlag/csvFlag columns of documents.json
+        """
+        self.available = {}
+        flags = {k: v for k, v in get_availability_flags().items() if v in self.meta.columns}
+        for rec in self.meta[['docID'] + list(flags.values())].to_dict('records'):
+            self.available[rec['docID']] = set([k for k in get_contenttypes().keys()
+                                                if k not in flags or str(rec[flags[k]]) == '1'])
+        return self
+
+    def prepare_ledger(self):
+        """
+        Loads the download ledger for this date; ledger.pending() lists the docIDs still to fetch.
+        Also notes which types EDINET has per docID, see _set_available_types.
+        """
+        self.ledger = DownloadLedger(self.basedir, self.meta, self.config).load()
+        self._set_available_types()
+        return self
+
     def download_all_data(self):
         """
+        Downloads all docIDs not yet flagged as downloaded in meta.csv.
+        Downloads run on a thread pool of config['max_workers'], throttled to
+        config['requests_per_second'] EDINET requests across the process.
         """
         #csv file is contained in a directory, and a bit tricky to parse.
         #alas, it is not the responsibility of the downloader and left to the parser
         #fn = 'C:/tmp/jplvh010000-lvh-001_E35450-000_2024-11-12_01_2024-11-19.csv'
         #df = pd.read_csv(fn, encoding="utf-16",sep='\t')
 
-        fn = self.basedir + '/meta.csv'
-        try:
-            cfn = 'gs://{bucketname}/{fn}'.format(bucketname=os.environ['BUCKETNAME'], fn=fn)
-            curmeta = pd.read_csv(cfn+'.gz')
-        except FileNotFoundError:
-            curmeta = None
-        if not curmeta is None:
-            curmeta = curmeta.reindex(columns=['docID', 'downloaded'])
-            curmeta.loc[:, 'downloaded'] = curmeta['downloaded'].fillna(False)
-            imeta = self.meta.merge(curmeta, on='docID', how='left')
-            imeta.loc[:, 'downloaded'] = imeta['downloaded'].fillna(False)
-        else:
-            imeta = self.meta.copy(deep=True)
-            imeta.loc[:, 'downloaded'] = False
-            gc.save_df_in_cloud(imeta, os.environ['BUCKETNAME'], fname=fn)
-        for i, row in tqdm(imeta.iterrows(), total=imeta.shape[0], desc="Processing rows"):
-            if row['downloaded'] == False:
-                time.sleep(2)
-                self._download_all_types_for_docID(row['docID'])
-                imeta.loc[imeta['docID'] == row['docID'], 'downloaded'] = True
-                gc.save_df_in_cloud(imeta, os.environ['BUCKETNAME'], fname=fn)
+        ledger = self.prepare_ledger().ledger
+        pending = ledger.pending()
+        max_workers = self.config.get('max_workers', get_download_defaults()['max_workers'])
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            futures = {ex.submit(self._download_all_types_for_docID, docID): docID for docID in pending}
+            for fut in tqdm(as_completed(futures), total=len(futures), desc="Processing rows"):
+                docID = futures[fut]
+                try:
+                    fut.result()
+                except Exception as e:
+                    #leave it flagged as not downloaded, the next run picks it up again
+                    print('download failed for docID={docID}: {e}'.format(docID=docID, e=e))
+                    failed.append(docID)
+                    continue
+                ledger.record(docID)
+        ledger.compact()
+        self.failed = failed
+        return self
 
 
 class MetaDataProcessorYuhos(MetaDataProcessor):
@@ -187,56 +529,191 @@ class MetaDataProcessorHanki(MetaDataProcessor):
             self.config['docdict'] = docdict
         #full fn will look like this: 'edinet/{doctypename}/{dtstr}'/{fext}/{docID}.{fullext}'
 
+def get_docid_index(fns, fext='csv'):
+    """
+    docID -> blob name, parsed from the .../{fext}/<docID>.<ext> naming convention,
+    e.g. 'edinet/tairyohoyu/20241119/csv/S100UN3D.csv.zip' -> {'S100UN3D': ...}
+    """
+    index = {}
+    for fn in fns:
+        parts = fn.split('/')
+        if len(parts) >= 2 and parts[-2] == fext:
+            index[parts[-1].split('.')[0]] = fn
+    return index
+
+class ElementIdNormalizer:
+    """
+    Memoized CamelCase -> snake_case normalizer for XBRL element ids, e.g.
+    'EDINETCodeDEI_jpdei_cor' -> 'edinet_code_dei_jpdei_cor'.
+    Works for the jplvh/jpdei ids of the large-holder csvs as well as the
+    jpcrp ids of yuho/hanki csvs. The taxonomy is a few hundred names, so
+    normalize() factorizes, normalizes only unseen uniques and maps back with a take.
+    The lookup table can be persisted with save() and passed back in as fn.
+    """
+    def __init__(self, fn=None):
+        self.lookup = {}
+        self.lock = threading.Lock()
+        if fn is not None and os.path.exists(fn):
+            tbl = pd.read_csv(fn, dtype=str, keep_default_na=False)
+            self.lookup = dict(zip(tbl['raw'], tbl['normalized']))
+
+    @staticmethod
+    def split_text(text:str):
+        text = text.replace('DEI', 'Dei').replace('EDINET', 'Edinet').replace('NA', 'Na')
+        result = re.findall(r'[A-Z][^A-Z]*', text)
+        return '_'.join([x.lower() for x in result])
+
+    def normalize_one(self, text:str):
+        if text not in self.lookup:
+            with self.lock:
+                self.lookup[text] = self.split_text(text)
+        return self.lookup[text]
+
+    def normalize(self, ids:pd.Series):
+        codes, uniques = pd.factorize(ids)
+        normalized = np.array([self.normalize_one(x) for x in uniques] + [np.nan], dtype=object)
+        return normalized[codes]
+
+    def save(self, fn):
+        tbl = pd.DataFrame(list(self.lookup.items()), columns=['raw', 'normalized'])
+        tbl.sort_values('raw').to_csv(fn, index=False)
+        return self
+
+
+_ELEMENT_ID_NORMALIZER = None
+
+def get_element_id_normalizer():
+    """
+    process wide normalizer, seeded from the table in $ELEMENT_ID_TABLE if set
+    """
+    global _ELEMENT_ID_NORMALIZER
+    if _ELEMENT_ID_NORMALIZER is None:
+        _ELEMENT_ID_NORMALIZER = ElementIdNormalizer(os.environ.get('ELEMENT_ID_TABLE'))
+    return _ELEMENT_ID_NORMALIZER
+
+def grouped_join(df, keys, col, sep=', '):
+    """
+    Same result as df.groupby(keys)[col].agg(lambda x: sep.join(x)), without calling
+    python per group: one stable sort, group boundaries from key changes, and a join
+    only for the (few) groups with more than one row. col has to hold strings.
+    """
+    df = df.dropna(subset=keys)
+    if df.shape[0] == 0:
+        return df.groupby(keys)[col].agg(lambda x: sep.join(x))
+    #mergesort is stable, i.e. rows keep their order within a group like in groupby
+    df = df.sort_values(keys, kind='mergesort')
+    keyvals = df.loc[:, keys].to_numpy(dtype=object)
+    newgroup = np.ones(keyvals.shape[0], dtype=bool)
+    newgroup[1:] = (keyvals[1:] != keyvals[:-1]).any(axis=1)
+    starts = np.flatnonzero(newgroup)
+    ends = np.append(starts[1:], keyvals.shape[0])
+    values = df[col].to_numpy(dtype=object)
+    out = values[starts].copy()
+    for i in np.flatnonzero((ends - starts) > 1):
+        out[i] = sep.join(values[starts[i]:ends[i]])
+    if len(keys) == 1:
+        index = pd.Index(keyvals[starts, 0], name=keys[0])
+    else:
+        index = pd.MultiIndex.from_arrays([keyvals[starts, i] for i in range(len(keys))], names=keys)
+    return pd.Series(out, index=index, name=col, dtype=df[col].dtype)
+
+def add_element_columns(df):
+    """
+    Adds id, mcat and holdnum from 要素ID / コンテキストID, e.g.
+    'jplvh_cor:NameOfIssuer' -> id='NameOfIssuer_jplvh_cor', mcat='jplvh_cor'
+    'FilerLargeVolumeHolder1Member' -> holdnum='Holder1', 'FilingDateInstant' -> 'Holder0'
+    There are only a few hundred distinct values per day, so the string work is done
+    once per unique value and mapped back to the rows with a take.
+    """
+    codes, uniques = pd.factorize(df['要素ID'])
+    parts = [x.split(':') for x in uniques]
+    #the trailing nan is picked up by code -1, i.e. missing values stay missing
+    ids = np.array([x[-1] + '_' + x[0] for x in parts] + [np.nan], dtype=object)
+    mcats = np.array([x[0] for x in parts] + [np.nan], dtype=object)
+    df.loc[:, 'id'] = ids[codes]
+    hcodes, huniques = pd.factorize(df['コンテキストID'])
+    holdnums = [x.split('FilerLargeVolume')[-1].replace('FilingDateInstant', 'Holder0').replace('Member', '')
+                for x in huniques]
+    holdnums = np.array(holdnums + [np.nan], dtype=object)
+    df.loc[:, 'holdnum'] = holdnums[hcodes]
+    df.loc[:, 'mcat'] = mcats[codes]
+    return df
+
+
 class ParseLargeHolders:
-    def __init__(self, dt:pd.Timestamp):
+    def __init__(self, dt:pd.Timestamp, storage=None):
         self.date = dt
+        if storage is None:
+            storage = st.get_storage()
+        self.storage = storage
         self.fndf = None
         self.meta = None
         self.df = None
         self.sumrytbl = None
+        self.fnindex = None
     
     def load_files_and_meta_data(self):
         fdir = 'edinet/tairyohoyu/{dt}'\
                .format(dt=self.date.strftime('%Y%m%d'))
-        ldir = gc.listdir(os.environ['BUCKETNAME'], fdir)
+        ldir = self.storage.listdir(fdir)
         xdf = pd.DataFrame([x.name for x in ldir], columns=['fn'])
         xdf.loc[:, 'date'] = pd.to_datetime(xdf['fn'].str.split('/').str.get(2), errors='coerce')
         filt = xdf['date'] == self.date
         filt &= xdf['fn'].str.contains('csv')
         filt &= ~xdf['fn'].str.contains('meta')
+        filt &= ~xdf['fn'].str.contains('/ledger/')
         self.fndf = xdf.loc[filt]
+        self.fnindex = get_docid_index(self.fndf['fn'])
         metafn = xdf.loc[xdf['fn'].str.contains('meta'), 'fn'].iloc[0]
-        fn = 'gs://{bucketname}/{fn}'.format(bucketname=os.environ['BUCKETNAME'],
-                                             fn=metafn)
-        print(fn)
-        self.meta = pd.read_csv(fn)
+        print(self.storage.url(metafn))
+        self.meta = self.storage.read_csv(metafn)
         return self
 
-    def parse_all_csvs(self):
+    def fetch_full_document(self, docID:str, typenumb:str='1'):
+        """
+        blob name of the full XBRL zip (or pdf with typenumb='2'), downloaded on first use
+        """
+        return fetch_document(self.date, docID, typenumb, 350, {'storage': self.storage})
+
+    def _read_lvh_csv(self, fn):
+        zfil = self.storage.load_zipfile(fn)
+        with zfil.open(zfil.filelist[0]) as zip_ext_file:
+            #read_csv decodes the utf-16 member straight from the zip stream, no BytesIO copy
+            df = pd.read_csv(zip_ext_file, sep='\t', encoding='utf-16')
+        df.loc[:, 'docID'] = fn.split('/')[-1].split('.')[0]
+        df = add_element_columns(df)
+        df.loc[:, 'value'] = df['値']
+        return df
+
+    def iter_csv_chunks(self, chunksize=50):
+        """
+        Yields the parsed filings of the day in deduplicated chunks of chunksize docIDs.
+        Duplicates never span docIDs, so deduplicating per chunk is enough.
+        docIDs of meta without a csv blob (csvFlag 0, failed downloads) are skipped.
+        """
+        normalizer = get_element_id_normalizer()
         dfs = []
-        for _, row in self.meta.iterrows():
-            fn = self.fndf.loc[self.fndf['fn'].str.contains(row['docID']), 'fn'].iloc[0]
-            zfil = gc.load_zipfile_from_cloud(os.environ['BUCKETNAME'], fn)
-            with zfil.open(zfil.filelist[0]) as zip_ext_file:
-                strm = io.BytesIO(zip_ext_file.read())
-                df = pd.read_csv(strm, sep='\t', encoding='utf-16')
-            df.loc[:, 'docID'] = fn.split('/')[-1].split('.')[0]
-            df.loc[:, 'id'] = df['要素ID'].str.split(':').str.get(-1) + '_' + df['要素ID'].str.split(':').str.get(0)
-            df.loc[:, 'holdnum'] = df['コンテキストID'].str.split('FilerLargeVolume').str.get(-1)
-            df.loc[:, 'holdnum'] = df['holdnum'].str.replace('FilingDateInstant', 'Holder0')
-            df.loc[:, 'holdnum'] = df['holdnum'].str.replace('Member', '')
-            df.loc[:, 'mcat'] = df['要素ID'].str.split(':').str.get(0)
-            df.loc[:, 'value'] = df['値']
-            dfs.append(df)
-        df = pd.concat(dfs)
-        df = df.drop_duplicates()
-        import re
-        def split_text(text):
-            result = re.findall(r'[A-Z][^A-Z]*', text)
-            return '_'.join([x.lower() for x in result])
-        df.loc[:, 'id'] = [split_text(x.replace('DEI', 'Dei')\
-                                       .replace('EDINET', 'Edinet')\
-                                       .replace('NA', 'Na')) for x in df['id']]
+        docIDs = self.meta['docID'].drop_duplicates().tolist()
+        missing = [x for x in docIDs if x not in self.fnindex]
+        if missing:
+            print('no csv for {n} docIDs of {dt}: {docIDs}'.format(n=len(missing), dt=self.date.strftime('%Y%m%d'),
+                                                                 docIDs=', '.join(missing)))
+        docIDs = [x for x in docIDs if x in self.fnindex]
+        for i, docID in enumerate(docIDs):
+            fn = self.fnindex[docID]
+            dfs.append(self._read_lvh_csv(fn))
+            if len(dfs) == chunksize or i == len(docIDs) - 1:
+                df = pd.concat(dfs).drop_duplicates()
+                dfs = []
+                df.loc[:, 'id'] = normalizer.normalize(df['id'])
+                yield df
+
+    def parse_all_csvs(self, chunksize=50):
+        """
+        The long table of the whole day in self.df. Not needed for prepare_for_parse,
+        which pivots chunk by chunk when self.df is not set.
+        """
+        df = pd.concat(list(self.iter_csv_chunks(chunksize)))
         #df = df.set_index(['id', 'docID', 'holdnum'])['value'].unstack('id')
         self.df = df
         return self
@@ -265,8 +742,10 @@ class ParseLargeHolders:
         }
         return rendict
 
-    def prepare_for_parse(self):
-        df = self.df.copy(deep=True)
+    def _pivot_chunk(self, df):
+        """
+        sdfd, sdfl and kdfl of one chunk of filings; every row belongs to exactly one docID
+        """
         df = df.drop_duplicates()
         filt = df['holdnum'] == 'Holder0'
         parent = df.loc[filt]
@@ -277,16 +756,28 @@ class ParseLargeHolders:
                     'filer_name_in_japanese_dei_jpdei_cor',
                     'security_code_dei_jpdei_cor']
         #sdfd = sdfd.loc[:, sdfdcols]
-        self.sdfd = sdfd
         sdfl = parent.loc[parent['mcat'].str.contains('lvh_cor')].set_index(['id', 'docID', 'holdnum'])['value'].unstack('id')
-        self.sdfl = sdfl
         kdfd = kids.loc[kids['mcat'].str.contains('dei_cor')].set_index(['id', 'docID', 'holdnum'])['value'].unstack('id')
         assert kdfd.shape[0] == 0
         #kdfl = kids.loc[kids['mcat'].str.contains('lvh_cor')].set_index(['id', 'docID', 'holdnum'])['value'].unstack('id')
-        self.kids = kids
+        kids = kids.loc[kids['mcat'].str.contains('lvh_cor')].copy()
         kids.loc[:, 'value'] = kids.loc[:, 'value'].astype(str)
-        kdfl = kids.loc[kids['mcat'].str.contains('lvh_cor')].groupby(['id', 'docID', 'holdnum'])['value'].agg(lambda x: ', '.join(x))
+        kdfl = grouped_join(kids, ['id', 'docID', 'holdnum'], 'value')
         kdfl = kdfl.unstack('id')
+        return sdfd, sdfl, kdfl
+
+    def prepare_for_parse(self, chunksize=50):
+        """
+        Pivots the filings into sdfd, sdfl and kdfl. Unless parse_all_csvs was called,
+        the csvs are read and pivoted chunksize docIDs at a time and only the small wide
+        tables are kept, so peak memory does not grow with the number of filings of the day.
+        """
+        chunks = [self.df] if self.df is not None else self.iter_csv_chunks(chunksize)
+        pivots = [self._pivot_chunk(x) for x in chunks]
+        #same row and column order as a pivot of the whole day
+        sdfd, sdfl, kdfl = [pd.concat([x[i] for x in pivots]).sort_index().sort_index(axis=1) for i in range(3)]
+        self.sdfd = sdfd
+        self.sdfl = sdfl
         self.kdfl = kdfl
         smrymeta = sdfl.loc[:, ['total_number_of_filers_and_joint_holders_cover_page_jplvh_cor',
                                 'holding_ratio_of_share_certificates_etc_jplvh_cor']]
@@ -322,21 +813,17 @@ class ParseLargeHolders:
                 'significant_contracts_related_to_said_stocks_etc_such_as_collateral_agreements_na',
                 'significant_contracts_related_to_said_stocks_etc_such_as_collateral_agreements_text_block']
         kdfs = []
+        #reset the index once, every column below only takes a two column slice of it
+        rkdfl = kdfl.reset_index('holdnum', drop=True).reset_index()
         for x in specialkcols:
-            tkdfl = kdfl.copy(deep=True)
-            tkdfl = kdfl.reset_index('holdnum', drop=True)\
-                        .reset_index().drop_duplicates(subset=['docID', x])\
-                        .loc[:, ['docID', x]]
+            tkdfl = rkdfl.loc[:, ['docID', x]].drop_duplicates(subset=['docID', x])
             tkdfl = tkdfl.dropna()
             tkdfl.loc[:, x] = tkdfl[x].astype(str)
-            kdfs.append(tkdfl.groupby('docID')[x].agg(lambda x: ', '.join(x)))
+            kdfs.append(grouped_join(tkdfl, ['docID'], x))
         amntcols = ['total_amount_from_other_sources',
             'total_amount_of_funding_for_acquisition']
         for x in amntcols:
-            tkdfl = kdfl.copy(deep=True)
-            tkdfl = kdfl.reset_index('holdnum', drop=True)\
-                        .reset_index().drop_duplicates(subset=['docID', x])\
-                        .loc[:, ['docID', x]]
+            tkdfl = rkdfl.loc[:, ['docID', x]].drop_duplicates(subset=['docID', x])
             tkdfl.loc[:, x] = pd.to_numeric(tkdfl[x], errors='coerce')
             kdfs.append(tkdfl.groupby('docID')[x].sum())
         kdf = pd.concat(kdfs, axis=1).reset_index()
@@ -397,14 +884,14 @@ class ParseLargeHolders:
             'total_number_of_outstanding_stocks_etc',
             'total_number_of_stocks_etc_held']
             #sdfd.loc[:, sdfd]
-        sdfd = self.sdfd.copy(deep=True)
-        sdfl = self.sdfl.copy(deep=True)
-        kdfl = self.kdfl.copy(deep=True)
+        #shallow copies are enough, only the column labels get replaced
+        sdfd = self.sdfd
+        sdfl = self.sdfl.copy(deep=False)
+        kdfl = self.kdfl.copy(deep=False)
         pids = self.promotedocIDs
         sumryids = self.sumrydocIDs
         kdfl.columns = kdfl.columns.str.replace('_jplvh_cor', '')
         sumryidskdfl = kdfl.loc[sumryids].reset_index().loc[:, commoncols]
-        sdfl = sdfl.copy(deep=True)
         sdfl.columns = sdfl.columns.str.replace('_jplvh_cor', '')
         pssdfl = sdfl.loc[pids].reset_index().loc[:, commoncols]
         pssdfl = pd.concat([sumryidskdfl, pssdfl])
@@ -415,19 +902,39 @@ class ParseLargeHolders:
         self.sumrytbl = pssdfl
         return self
     
-    def save_summary(self):
-        fn = 'gs://{bucketname}/tairyohoyu/parsed/summary/{YYYYMMDD}.csv.gz'\
-             .format(bucketname=os.environ['BUCKETNAME'],
-                     YYYYMMDD=self.date.strftime('%Y%m%d'))
-        print(fn)
-        self.sumrytbl.to_csv(fn, index=False)
-        fn = 'gs://{bucketname}/tairyohoyu/parsed/kids/{YYYYMMDD}.csv.gz'\
-             .format(bucketname=os.environ['BUCKETNAME'],
-                     YYYYMMDD=self.date.strftime('%Y%m%d'))
-        print(fn)
-        self.kdfl.to_csv(fn)
+    def save_summary(self, fmt='csv'):
+        """
+        fmt='csv' writes one gzipped csv per day, fmt='parquet' writes typed parquet
+        partitions, see save_summary_parquet
+        """
+        if fmt == 'parquet':
+            return self.save_summary_parquet()
+        fn = 'tairyohoyu/parsed/summary/{YYYYMMDD}.csv.gz'\
+             .format(YYYYMMDD=self.date.strftime('%Y%m%d'))
+        print(self.storage.url(fn))
+        self.storage.to_csv(self.sumrytbl, fn, index=False)
+        fn = 'tairyohoyu/parsed/kids/{YYYYMMDD}.csv.gz'\
+             .format(YYYYMMDD=self.date.strftime('%Y%m%d'))
+        print(self.storage.url(fn))
+        self.storage.to_csv(self.kdfl, fn)
+        return self
+
+    def save_summary_parquet(self):
+        """
+        tairyohoyu/parsed/summary_parquet/date=YYYY-MM-DD/part-0.parquet
+        tairyohoyu/parsed/kids_parquet/date=YYYY-MM-DD/part-0.parquet
+        Holding ratios and share counts are numeric, dates are datetimes, and
+        filer/issuer names are categoricals (dictionary encoded in parquet).
+        """
+        dtstr = self.date.strftime('%Y-%m-%d')
+        for tbl, df in [('summary', self.sumrytbl), ('kids', self.kdfl.reset_index())]:
+            fn = 'tairyohoyu/parsed/{tbl}_parquet/date={dtstr}/part-0.parquet'\
+                 .format(tbl=tbl, dtstr=dtstr)
+            print(self.storage.url(fn))
+            df = to_typed_summary(df)
+            self.storage.to_parquet(df, fn, index=False, schema=get_summary_schema(df.columns))
         return self
-        
+
 
     def get_summary_table(self):
         kcols = ['docID',
@@ -454,61 +961,229 @@ class ParseLargeHolders:
         'total_amount_of_funding_for_acquisition']
         return self.sumrytbl.loc[:, kcols]
 
-def run_parser_for_date(dt:pd.Timestamp):
+def get_summary_column_types():
+    numcols = ['holding_ratio_of_share_certificates_etc',
+               'holding_ratio_of_share_certificates_etc_per_last_report',
+               'total_number_of_outstanding_stocks_etc',
+               'total_number_of_stocks_etc_held',
+               'number_of_residual_stocks_held',
+               'number_of_stocks_etc_to_deduct_as_rights_to_demand_exist_between_joint_holders',
+               'number_of_stocks_etc_to_deduct_as_sold_on_margin_trading',
+               'total_number_of_filers_and_joint_holders_cover_page',
+               'total_amount_from_other_sources',
+               'total_amount_of_funding_for_acquisition',
+               'number_of_submission_dei_jpdei_cor']
+    datecols = ['base_date',
+                'filing_date_cover_page',
+                'date_when_filing_requirement_arose_cover_page']
+    catcols = ['edinet_code_dei_jpdei_cor',
+               'filer_name_in_english_dei_jpdei_cor',
+               'filer_name_in_japanese_dei_jpdei_cor',
+               'security_code_dei_jpdei_cor',
+               'document_type_dei_jpdei_cor',
+               'security_code_of_issuer',
+               'name_of_issuer',
+               'name_cover_page',
+               'place_of_filing_cover_page',
+               'listed_or_o_t_c',
+               'stock_listing']
+    return numcols, datecols, catcols
+
+def to_typed_summary(df):
+    """
+    Typed copy of a summary/kids table for parquet. Works on either naming
+    (with or without the _jplvh_cor suffix). The article27233 columns are share counts.
+    """
+    numcols, datecols, catcols = get_summary_column_types()
+    df = df.copy(deep=True)
+    for x in df.columns:
+        bx = x.replace('_jplvh_cor', '')
+        if bx in numcols or 'article27233' in bx:
+            df[x] = pd.to_numeric(df[x], errors='coerce').astype('float64')
+        elif bx in datecols:
+            df[x] = pd.to_datetime(df[x], errors='coerce')
+        elif bx in catcols:
+            df[x] = df[x].astype(str).where(df[x].notnull()).astype('category')
+        elif df[x].dtype == object:
+            df[x] = df[x].astype('string')
+    return df
+
+def get_summary_schema(columns):
+    """
+    pyarrow schema for to_typed_summary output. The type of a column only depends on its
+    name, not on the day's values (e.g. an all-null name column), so the partitions of
+    different days always unify in load_summary_history.
+    """
+    import pyarrow as pa
+    numcols, datecols, catcols = get_summary_column_types()
+    fields = []
+    for x in columns:
+        bx = x.replace('_jplvh_cor', '')
+        if bx in numcols or 'article27233' in bx:
+            typ = pa.float64()
+        elif bx in datecols:
+            typ = pa.timestamp('ns')
+        elif bx in catcols:
+            typ = pa.dictionary(pa.int32(), pa.string())
+        else:
+            typ = pa.string()
+        fields.append(pa.field(x, typ))
+    return pa.schema(fields)
+
+def load_summary_history(start=None, end=None, columns=None, tbl='summary'):
+    """
+    Reads the parquet summaries (or kids with tbl='kids') of a filing date range in one go,
+    only touching the partitions in [start, end] and only the requested columns.
+    Columns missing on some days come back as nulls for those days.
+    """
+    fn = 'tairyohoyu/parsed/{tbl}_parquet/'.format(tbl=tbl)
+    filters = []
+    if start is not None:
+        filters.append(('date', '>=', pd.Timestamp(start).strftime('%Y-%m-%d')))
+    if end is not None:
+        filters.append(('date', '<=', pd.Timestamp(end).strftime('%Y-%m-%d')))
+    if columns is not None and 'date' not in columns:
+        columns = list(columns) + ['date']
+    df = st.get_storage().read_parquet_dataset(fn, columns=columns, filters=filters if filters else None)
+    return df
+
+def run_parser_for_date(dt:pd.Timestamp, fmt='csv', history=None):
+    """
+    history: optional HolderHistory.LargeHolderHistory the day gets appended to
+    """
     plh = ParseLargeHolders(dt)
     plh = plh.load_files_and_meta_data()
-    plh = plh.parse_all_csvs()
     plh = plh.prepare_for_parse()
     plh = plh.parse_full_summary_table()
-    plh = plh.save_summary()
+    plh = plh.save_summary(fmt=fmt)
+    if history is not None:
+        history.append(plh.sumrytbl, dt)
     #kdf = plh.get_summary_table()
 
-def parse_for_all_dates():
-    fdir = 'edinet/tairyohoyu/'
-    ldir = gc.listdir(os.environ['BUCKETNAME'], fdir)
-    ldirdf = pd.DataFrame(ldir)
-    ldirdf = pd.DataFrame([x.name for x in ldirdf[0]])
-    ldirdf.columns = ['fn']
-    ldirdf.loc[:, 'date'] = ldirdf['fn'].str.split('/').str.get(2)
-    ldirdf.loc[:, 'date'] = pd.to_datetime(ldirdf['date'], errors='coerce')
-    ldirdf = ldirdf.loc[ldirdf['date'] < '2020-07-20', ['date']].drop_duplicates()
-    ldirdf = ldirdf.sort_values('date', ascending=False)
-    for _, row in tqdm(ldirdf.iterrows(), total=ldirdf.shape[0], desc='Processing'):
-        try:
-            run_parser_for_date(row['date'])
-        except (ValueError, IndexError):
-            print('value error for date={dtstr}'.format(dtstr=row['date'].strftime('%Y%m%d')))
+def _list_blob_times(fdir, datepos, pattern=None):
+    """
+    latest blob update time per date directory under fdir, only of blobs matching pattern if given
+    """
+    ldir = st.get_storage().listdir(fdir)
+    ldirdf = pd.DataFrame([(x.name, x.updated) for x in ldir], columns=['fn', 'updated'])
+    if pattern is not None:
+        ldirdf = ldirdf.loc[ldirdf['fn'].str.contains(pattern)]
+    #YYYYMMDD, YYYYMMDD.csv.gz or date=YYYY-MM-DD
+    ldirdf.loc[:, 'date'] = ldirdf['fn'].str.split('/').str.get(datepos).str.split('.').str.get(0)\
+                                 .str.replace('date=', '').str.replace('-', '')
+    ldirdf.loc[:, 'date'] = pd.to_datetime(ldirdf['date'], format='%Y%m%d', errors='coerce')
+    ldirdf = ldirdf.dropna(subset=['date'])
+    return ldirdf.groupby('date')['updated'].max()
+
+def get_dates_to_parse(force=False, enddate='2020-07-20', fmt='csv'):
+    """
+    Dates with downloaded large-holder filings, newest first. Unless force, dates whose
+    parsed summary is newer than all of their input blobs are skipped.
+    The inputs are meta.csv.gz and the csv zips; full zips and pdfs fetched later
+    on demand (fetch_document) do not trigger a reparse.
+    """
+    intimes = _list_blob_times('edinet/tairyohoyu/', 2, pattern=r'/(?:meta\.csv\.gz$|csv/)')
+    if enddate is not None:
+        intimes = intimes.loc[intimes.index < enddate]
+    if not force:
+        outdir = 'tairyohoyu/parsed/summary/' if fmt == 'csv' else 'tairyohoyu/parsed/summary_parquet/'
+        outtimes = _list_blob_times(outdir, 3).reindex(intimes.index)
+        intimes = intimes.loc[~(outtimes >= intimes)]
+    return intimes.sort_index(ascending=False).index.tolist()
+
+def _run_parser_for_date_safe(dt:pd.Timestamp, fmt='csv'):
+    try:
+        run_parser_for_date(dt, fmt=fmt)
+    except (ValueError, IndexError, KeyError) as e:
+        return '{etype} for date={dtstr}: {e}'.format(etype=type(e).__name__, dtstr=dt.strftime('%Y%m%d'), e=e)
+    return None
+
+def parse_for_all_dates(parallel=False, max_workers=None, force=False, enddate='2020-07-20', fmt='csv'):
+    """
+    Reparses all dates that changed since their last parse (all dates if force).
+    parallel fans the dates out over a process pool, the pandas work is CPU bound.
+    The workers use the parent's storage backend, also under spawn (the Windows default).
+    """
+    dates = get_dates_to_parse(force=force, enddate=enddate, fmt=fmt)
+    if parallel:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=st.init_worker,
+                                 initargs=(st.get_storage().spec(),)) as ex:
+            futures = [ex.submit(_run_parser_for_date_safe, dt, fmt) for dt in dates]
+            msgs = [fut.result() for fut in tqdm(as_completed(futures), total=len(futures), desc='Processing')]
+    else:
+        msgs = [_run_parser_for_date_safe(dt, fmt) for dt in tqdm(dates, desc='Processing')]
+    for msg in msgs:
+        if msg is not None:
+            print(msg)
+    return dates
 
 
 def run_edinet_downloads_for_date(dt:pd.Timestamp, cfg=None):
     if cfg is None:
-        cfg = {'doctypecode':350}
+        cfg = get_pipeline_config(350)
     ed = MetaDataProcessor(dt, config=cfg)
     ed = ed.read_all_meta_data()
     if ed.meta.shape[0] != 0:
         ed = ed._filter_metadata()
         ed = ed.download_all_data()
 
+def fetch_document(dt:pd.Timestamp, docID:str, typenumb:str='1', doctypecode:int=350, config=None):
+    """
+    On-demand fetch of a type the pipeline's docdict skips, e.g. the full XBRL zip of a
+    large-holder filing. Returns the blob name, downloads only if it is not stored yet.
+    """
+    cfg = get_pipeline_config(doctypecode)
+    if config is not None:
+        cfg.update(config)
+    mdp = MetaDataProcessor(dt, config=cfg)
+    fname = mdp.get_blob_name(docID, typenumb)
+    if (cfg.get('storage') or st.get_storage()).exists(fname):
+        return fname
+    return mdp._download_type_for_docID(docID, typenumb)
+
 def run_tairyohoyu_download_for_date(dt:pd.Timestamp):
-    cfg = {'doctypecode':350}
+    cfg = get_pipeline_config(350)
     run_edinet_downloads_for_date(dt, cfg)
 
 
+def get_topix_cache():
+    """
+    TOPIX weight file from tsetools, downloaded at most once per TTL and snapshotted on disk
+    """
+    return uc.get_universe_cache('tse_topix_weights', tt.load_current_topix_file_from_tse,
+                                 codecol='コード')
+
+def resolve_seccodes(df, asof=None):
+    """
+    secCode of each filing; where documents.json has none, it is looked up from the
+    edinetCode in the security master snapshot valid at asof, by default the submission
+    date of the listing. Without such a snapshot (see SecurityMaster.get_security_master_dir)
+    the secCodes of documents.json are returned unchanged.
+    """
+    seccodes = df['secCode']
+    if asof is None and 'submitDateTime' in df.columns:
+        asof = pd.to_datetime(df['submitDateTime'], errors='coerce').min()
+    if asof is None or pd.isnull(asof):
+        return seccodes.astype(str)
+    try:
+        secmaster = sm.get_security_master(asof=asof)
+    except FileNotFoundError:
+        return seccodes.astype(str)
+    seccodes = seccodes.where(seccodes.notnull(), secmaster.lookup(df['edinetCode'], 'edinetcode', 'secCode'))
+    return seccodes.astype(str)
+
 def filter_by_topix_function_yuho_logic(df):
     """
     keep file if it is either in topix or a REIT
     """
-    tpx = tt.load_current_topix_file_from_tse()
-    tpx.loc[:, 'secCode'] = tpx['コード'].astype(str) + '0'
-    filt = (df['secCode'].astype(str).isin(tpx['secCode']) | df['formCode'].astype(str).isin(['07B000']))
+    seccodes = get_topix_cache().get_seccodes()
+    filt = (resolve_seccodes(df).isin(seccodes) | df['formCode'].astype(str).isin(['07B000']))
     filt &= (df['docTypeCode'] == '120')
     return df.loc[filt]
 
 
 def run_yuho_downloads_for_date(dt:pd.Timestamp):
-    cfg = {'doctypecode':120,
-           'formCodes': ['030000', '07B000'],
-           'filterfun': filter_by_topix_function_yuho_logic}
+    cfg = get_pipeline_config(120)
     run_edinet_downloads_for_date(dt, cfg)
 
 #doctype=160 doctype=140 and or formCode = '043000' and docDescription.str.contains('
@@ -516,17 +1191,124 @@ def filter_by_topix_function_hanki_logic(df):
     """
     keep file if it is either in topix or a REIT
     """
-    tpx = tt.load_current_topix_file_from_tse()
-    tpx.loc[:, 'secCode'] = tpx['コード'].astype(str) + '0'
-    filt = df['secCode'].astype(str).isin(tpx['secCode'])
+    seccodes = get_topix_cache().get_seccodes()
+    filt = resolve_seccodes(df).isin(seccodes)
     filt &= (df['docTypeCode'] == '160') | ((df['docTypeCode'] == '140') & df['docDescription'].str.contains('第2四半期'))
     return df.loc[filt]
 
 def run_hanki_downloads_for_date(dt:pd.Timestamp):
-    cfg = {'doctypecode':160,
-           'filterfun': filter_by_topix_function_hanki_logic}
+    cfg = get_pipeline_config(160)
     run_edinet_downloads_for_date(dt, cfg)
 
+def get_pipeline_config(doctypecode:int):
+    """
+    Download config per pipeline: 350 large holders, 120 yuho, 160 hanki.
+    Returns a fresh dict, MetaDataProcessor adds its defaults to it.
+    """
+    #docdict: the content types the pipeline's parsers consume, the rest can be
+    #fetched on demand with fetch_document
+    if doctypecode == 350:
+        cfg = {'doctypecode':350,
+               'docdict': get_contenttypes(['5'])}
+    elif doctypecode == 120:
+        cfg = {'doctypecode':120,
+               'formCodes': ['030000', '07B000'],
+               'filterfun': filter_by_topix_function_yuho_logic}
+    elif doctypecode == 160:
+        cfg = {'doctypecode':160,
+               'filterfun': filter_by_topix_function_hanki_logic}
+    else:
+        cfg = {'doctypecode':doctypecode}
+    return cfg
+
+
+class BackfillScheduler:
+    """
+    Backfills a business-day range for one doctypecode (350/120/160).
+    The daily documents.json listings are fetched concurrently, the pending docIDs
+    of all dates are merged into one work queue, and that queue feeds a single
+    download pool. Progress and ETA are reported for the whole range.
+    All EDINET calls share the process-wide session and rate limiter (see edinet_get).
+    """
+    def __init__(self, start, end, doctypecode:int, config=None):
+        self.dates = pd.bdate_range(start, end)
+        self.doctypecode = doctypecode
+        if config is None:
+            config = {}
+        self.config = config
+        self.processors = []
+        self.queue = []
+        self.failed = []
+        self.faileddates = []
+
+    def _make_config(self):
+        cfg = get_pipeline_config(self.doctypecode)
+        cfg.update(self.config)
+        return cfg
+
+    def _read_listing(self, dt:pd.Timestamp):
+        ed = MetaDataProcessor(dt, config=self._make_config())
+        ed = ed.read_all_meta_data()
+        if ed.meta.shape[0] == 0:
+            return None
+        return ed._filter_metadata()
+
+    def fetch_listings(self):
+        max_workers = self.config.get('max_workers', get_download_defaults()['max_workers'])
+        processors = []
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            futures = {ex.submit(self._read_listing, dt): dt for dt in self.dates}
+            for fut in tqdm(as_completed(futures), total=len(futures), desc='Fetching listings'):
+                dt = futures[fut]
+                try:
+                    ed = fut.result()
+                except Exception as e:
+                    print('listing failed for date={dtstr}: {e}'.format(dtstr=dt.strftime('%Y%m%d'), e=e))
+                    self.faileddates.append(dt)
+                    continue
+                if ed is not None:
+                    processors.append(ed)
+        self.processors = sorted(processors, key=lambda x: x.date)
+        return self
+
+    def build_queue(self):
+        queue = []
+        for ed in self.processors:
+            ed = ed.prepare_ledger()
+            queue.extend([(ed, docID) for docID in ed.ledger.pending()])
+        self.queue = queue
+        return self
+
+    def download_all(self):
+        max_workers = self.config.get('max_workers', get_download_defaults()['max_workers'])
+        remaining = {}
+        for ed, _ in self.queue:
+            remaining[ed.basedir] = remaining.get(ed.basedir, 0) + 1
+        #dates with nothing left still get their ledger segments compacted
+        for ed in self.processors:
+            if remaining.get(ed.basedir, 0) == 0:
+                ed.ledger.compact()
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            futures = {ex.submit(ed._download_all_types_for_docID, docID): (ed, docID) for ed, docID in self.queue}
+            for fut in tqdm(as_completed(futures), total=len(futures), desc='Downloading {n} dates'.format(n=len(self.processors))):
+                ed, docID = futures[fut]
+                try:
+                    fut.result()
+                    ed.ledger.record(docID)
+                except Exception as e:
+                    print('download failed for docID={docID}: {e}'.format(docID=docID, e=e))
+                    failed.append(docID)
+                remaining[ed.basedir] -= 1
+                if remaining[ed.basedir] == 0:
+                    ed.ledger.compact()
+        self.failed = failed
+        return self
+
+    def run(self):
+        return self.fetch_listings().build_queue().download_all()
+
+
 def run_tairyohoyu_download(arg1=None, arg2=None):
     dt = pd.Timestamp.now().normalize()
     run_tairyohoyu_download_for_date(dt)
@@ -600,59 +1382,230 @@ def screening_for_investment_funds(sdf):
     #likely better to track funds explicitly
     return df.loc[invholdfilt]
 
+def get_llm_defaults():
+    #model: chat model used for the text block extraction
+    #max_workers: completion requests in flight
+    #requests_per_second: sustained completion request rate of one extractor
+    #max_retries: attempts per text, a reply that fails the table check is retried
+    #backoff: seconds before the first retry, doubled for every further one
+    #cachedir: replies are cached by content hash of model + prompt, see ResponseCache
+    defaults = {'model': 'gpt-4o-mini',
+                'max_workers': 8,
+                'requests_per_second': 5.0,
+                'max_retries': 3,
+                'backoff': 1.0,
+                'cachedir': os.environ.get('LLM_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'llm_cache'))}
+    return defaults
+
+_OPENAI_CLIENT = None
+_OPENAI_LOCK = threading.Lock()
+
+def get_openai_client():
+    """
+    One OpenAI client per process, it keeps its own connection pool.
+    I expect you to set the api key in the enviroment
+    """
+    global _OPENAI_CLIENT
+    with _OPENAI_LOCK:
+        if _OPENAI_CLIENT is None:
+            _OPENAI_CLIENT = OpenAI()
+    return _OPENAI_CLIENT
+
+def openai_completion(prompt:str, model:str):
+    completion = get_openai_client().chat.completions.create(
+        model=model,
+        store=True,
+        messages=[
+            {"role": "user", "content": prompt}
+        ]
+    )
+    return completion.choices[0].to_dict()['message']['content']
+
+def parse_pipe_table(content:str, min_columns:int=2):
+    """
+    | separated table of a completion, inside ``` fences if there are any.
+    Raises ValueError unless there is a header plus at least one row and every line has
+    the header's number of fields.
+    """
+    strdata = content.split('```')[1] if content.count('```') >= 2 else content
+    #thing might have some garbage - which we need to get rid of
+    lines = [x for x in strdata.split('\n') if '|' in x]
+    if len(lines) < 2:
+        raise ValueError('no table in the reply')
+    nfields = [len(x.split('|')) for x in lines]
+    if nfields[0] < min_columns or any([x != nfields[0] for x in nfields]):
+        raise ValueError('ragged table in the reply: {nfields}'.format(nfields=nfields))
+    strdata = '\n'.join(lines)
+    df = pd.read_csv(io.StringIO(strdata), sep='|')
+    return df, strdata
+
+
+class LLMExtractor:
+    """
+    Batch table extraction from text blocks. Requests run on a thread pool under the
+    extractor's own token bucket; replies are cached by sha256 of model + prompt, so an
+    unchanged text block is never sent again, and only replies that pass
+    parse_pipe_table are cached. complete(prompt, model) -> reply text is pluggable,
+    e.g. a local stub in tests; the default goes through the shared OpenAI client.
+    ex = LLMExtractor().extract({'S100XXXX': text, ...}, prompt)
+    ex.results: key -> DataFrame, ex.raw: key -> table text, ex.failed: key -> error
+    """
+    def __init__(self, complete=None, config=None):
+        cfg = get_llm_defaults()
+        if config is not None:
+            cfg.update(config)
+        self.config = cfg
+        if complete is None:
+            complete = openai_completion
+        self.complete = complete
+        self.limiter = TokenBucket(cfg['requests_per_second'])
+        self.cache = rc.get_response_cache({'http_cache_dir': cfg['cachedir']}) if cfg['cachedir'] else None
+        self.results = {}
+        self.raw = {}
+        self.failed = {}
+
+    def _extract_one(self, prompt:str):
+        model = self.config['model']
+        cachekey = ('chat.completions', hashlib.sha256(prompt.encode('utf-8')).hexdigest(), model)
+        if self.cache is not None:
+            content = self.cache.get(*cachekey)
+            if content is not None:
+                return parse_pipe_table(content.decode('utf-8'))
+        if self.config['max_retries'] < 1:
+            raise ValueError('max_retries must be at least 1, got {n}'.format(n=self.config['max_retries']))
+        for attempt in range(self.config['max_retries']):
+            if attempt > 0:
+                time.sleep(self.config['backoff'] * 2**(attempt - 1))
+            self.limiter.acquire()
+            try:
+                content = self.complete(prompt, model)
+                df, strdata = parse_pipe_table(content)
+            except Exception as e:
+                if attempt == self.config['max_retries'] - 1:
+                    raise
+                continue
+            if self.cache is not None:
+                self.cache.put(*cachekey, content.encode('utf-8'))
+            return df, strdata
+
+    def extract(self, texts, txtstr:str):
+        """
+        texts: key -> text block; each prompt is txtstr + text
+        """
+        self.results = {}
+        self.raw = {}
+        self.failed = {}
+        with ThreadPoolExecutor(max_workers=self.config['max_workers']) as ex:
+            futures = {ex.submit(self._extract_one, txtstr + text): key for key, text in texts.items()}
+            for fut in tqdm(as_completed(futures), total=len(futures), desc='Extracting'):
+                key = futures[fut]
+                try:
+                    self.results[key], self.raw[key] = fut.result()
+                except Exception as e:
+                    self.failed[key] = '{e}'.format(e=e)
+        return self
+
+
+def get_holder_prompt():
+    return 'Convert the text after this sentence into a csv file format, using | as a separator. '
+
+
 class HankiHolders:
-    def __init__(self):
+    def __init__(self, storage=None):
+        if storage is None:
+            storage = st.get_storage()
+        self.storage = storage
         self.top10 = None
         #contains the raw text
         self.csvdf = None
+        self.fnindex = None
+
+    def load_index(self, dt:pd.Timestamp):
+        """
+        docID -> blob name for all hanki csv zips of date dt
+        """
+        fdir = 'edinet/hanki/{dt}/csv/'.format(dt=dt.strftime('%Y%m%d'))
+        ldir = self.storage.listdir(fdir)
+        self.fnindex = get_docid_index([x.name for x in ldir])
+        return self
     
-    def read_from_cloud(self, fn = 'edinet/hanki/20241111/csv/S100UN3D.csv.zip'):
-        zfil = gc.load_zipfile_from_cloud(os.environ['BUCKETNAME'], fn)
+    def read_from_cloud(self, fn = 'edinet/hanki/20241111/csv/S100UN3D.csv.zip', docID=None):
+        if docID is not None:
+            #requires load_index
+            if docID not in self.fnindex:
+                raise FileNotFoundError('no hanki csv stored for docID={docID}'.format(docID=docID))
+            fn = self.fnindex[docID]
+        self.csvdf = self._read_csv(fn)
+        return self
+
+    def _read_csv(self, fn):
+        zfil = self.storage.load_zipfile(fn)
         largestfileidx = pd.Series([x.compress_size for x in zfil.filelist]).idxmax()
         with zfil.open(zfil.filelist[largestfileidx]) as zip_ext_file:
-            strm = io.BytesIO(zip_ext_file.read())
-            df = pd.read_csv(strm, sep='\t', encoding='utf-16')
-        self.csvdf = df
-        return self
+            df = pd.read_csv(zip_ext_file, sep='\t', encoding='utf-16')
+        return df
     
-    def _extract_top10holders_text(self, komoku='MajorShareholdersTextBlock'):
-        ookabustr = self.csvdf.loc[self.csvdf['要素ID'].str.contains(komoku), '値'].iloc[0]
+    def _extract_top10holders_text(self, komoku='MajorShareholdersTextBlock', csvdf=None):
+        if csvdf is None:
+            csvdf = self.csvdf
+        ookabustr = csvdf.loc[csvdf['要素ID'].str.contains(komoku), '値'].iloc[0]
         return ookabustr
     
-    def _parse_text_with_chatgpt(self, komoku='MajorShareholdersTextBlock', dfname='top10', txtstr=None):
+    def _parse_text_with_chatgpt(self, komoku='MajorShareholdersTextBlock', dfname='top10', txtstr=None,
+                                 extractor=None):
         if txtstr is None:
-            txtstr = 'Convert the text after this sentence into a csv file format, using | as a separator. '
-        #I expect you to set the api key in the enviroment
-        client = OpenAI()
+            txtstr = get_holder_prompt()
+        if extractor is None:
+            extractor = LLMExtractor()
         ookabustr = self._extract_top10holders_text(komoku=komoku)
-        completion = client.chat.completions.create(
-        model="gpt-4o-mini",
-        store=True,
-        messages=[
-            {"role": "user", "content": txtstr + ookabustr}
-        ]
-        )
-        strdata = completion.choices[0].to_dict()['message']['content'].split('```')[1]
-        #thing might have some garbage - which we need to get rid of
-        strdata = '\n'.join([x for x in strdata.split('\n') if '|' in x])
-        self.strdata = strdata
-        stream = io.StringIO(strdata)
-        df = pd.read_csv(stream, sep='|')
-        setattr(self, dfname, df)
+        extractor.extract({dfname: ookabustr}, txtstr)
+        if dfname in extractor.failed:
+            raise ValueError(extractor.failed[dfname])
+        self.strdata = extractor.raw[dfname]
+        setattr(self, dfname, extractor.results[dfname])
+        return self
+
+    def extract_holders_for_date(self, dt:pd.Timestamp, docIDs=None, komoku='MajorShareholdersTextBlock',
+                                 txtstr=None, extractor=None):
+        """
+        Runs the text block extraction for many filings of date dt at once (default: all of them).
+        self.holders has the tables of all filings with a docID column, self.failed the
+        docIDs that could not be read or extracted.
+        """
+        if txtstr is None:
+            txtstr = get_holder_prompt()
+        if extractor is None:
+            extractor = LLMExtractor()
+        self.load_index(dt)
+        if docIDs is None:
+            docIDs = list(self.fnindex.keys())
+        texts = {}
+        self.failed = {}
+        def read_text(docID):
+            return self._extract_top10holders_text(komoku=komoku, csvdf=self._read_csv(self.fnindex[docID]))
+        with ThreadPoolExecutor(max_workers=extractor.config['max_workers']) as ex:
+            futures = {ex.submit(read_text, docID): docID for docID in docIDs}
+            for fut in as_completed(futures):
+                try:
+                    texts[futures[fut]] = fut.result()
+                except Exception as e:
+                    self.failed[futures[fut]] = '{e}'.format(e=e)
+        extractor.extract(texts, txtstr)
+        self.failed.update(extractor.failed)
+        dfs = [df.assign(docID=docID) for docID, df in extractor.results.items()]
+        self.holders = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
         return self
 
 def run_yuho_for_year(arg1=None, arg2=None):
     #name = request.args.get('name', 'World')
     yrstr = arg1.args.get('year', '2024')
-    for dt in pd.bdate_range('{year}-06-20'.format(year=yrstr),
-                          '{year}-12-31'.format(year=yrstr)):
-        run_yuho_downloads_for_date(dt)
+    BackfillScheduler('{year}-06-20'.format(year=yrstr),
+                      '{year}-12-31'.format(year=yrstr), 120).run()
 
 def run_hanki_for_year(arg1=None, arg2=None):
     yrstr = '2024'
-    for dt in pd.bdate_range('{year}-01-01'.format(year=yrstr),
-                             '{year}-10-01'.format(year=yrstr)):
-        run_hanki_downloads_for_date(dt)
+    BackfillScheduler('{year}-01-01'.format(year=yrstr),
+                      '{year}-10-01'.format(year=yrstr), 160).run()
 
 if __name__ == '__main__':
     run_tairyohoyu_download()
\ No newline at end of file
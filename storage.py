@@ -0,0 +1,360 @@
+"""
+Storage backends for the edinet pipeline. Blob names are bucket-relative paths like
+edinet/tairyohoyu/YYYYMMDD/meta.csv.gz on every backend.
+
+CloudStorage   google cloud storage bucket, one pooled client per process
+LocalStorage   a local directory tree laid out like the bucket (offline runs, tests, benchmarks)
+CachedStorage  read-through / write-through local disk cache in front of another backend
+
+get_storage() returns the process default, configured by environment variables:
+EDINET_STORAGE    'gs' (default, bucket $BUCKETNAME) or a local directory
+EDINET_CACHE_DIR  if set, wrap the backend in a CachedStorage on that directory
+"""
+import os
+import io
+import time
+import shutil
+import zipfile
+import datetime
+import threading
+import pandas as pd
+
+
+class StoredBlob:
+    """
+    what listdir returns on every backend, same attributes as a google cloud Blob
+    """
+    def __init__(self, name:str, updated:datetime.datetime, size:int=None):
+        self.name = name
+        self.updated = updated
+        self.size = size
+
+
+def _compression(fname):
+    return 'gzip' if fname.endswith('.gz') else None
+
+
+class Storage:
+    """
+    Common interface. Backends implement _read_bytes, _write_stream, listdir, exists, delete and url;
+    the DataFrame helpers are built on top of those.
+    """
+    def _read_bytes(self, fname:str) -> bytes:
+        raise NotImplementedError
+
+    def _write_stream(self, strm, fname:str, contenttype:str=None, size:int=None):
+        raise NotImplementedError
+
+    def listdir(self, prefix:str):
+        raise NotImplementedError
+
+    def exists(self, fname:str) -> bool:
+        raise NotImplementedError
+
+    def size(self, fname:str):
+        raise NotImplementedError
+
+    def delete(self, fname:str):
+        """
+        removes fname, missing blobs are ignored
+        """
+        raise NotImplementedError
+
+    def url(self, fname:str) -> str:
+        """
+        path or url pandas/pyarrow can open directly, used for partitioned parquet reads
+        """
+        raise NotImplementedError
+
+    def spec(self):
+        """
+        picklable description of the backend, from_spec rebuilds it (e.g. in a worker process)
+        """
+        raise NotImplementedError
+
+    def open_read(self, fname:str):
+        return io.BytesIO(self._read_bytes(fname))
+
+    def save_stream(self, strm, fname:str, contenttype:str=None, size:int=None):
+        """
+        strm needs read() and tell(); size is the number of bytes it holds, if known
+        """
+        self._write_stream(strm, fname, contenttype=contenttype, size=size)
+        return self
+
+    def save_df(self, df:pd.DataFrame, fname:str):
+        """
+        gzipped csv stored under fname + '.gz', like gcs_utils.save_df_in_cloud
+        """
+        self.to_csv(df, fname + '.gz', index=False)
+        return self
+
+    def load_zipfile(self, fname:str):
+        return zipfile.ZipFile(self.open_read(fname))
+
+    def read_csv(self, fname:str, **kwargs):
+        kwargs.setdefault('compression', _compression(fname))
+        with self.open_read(fname) as f:
+            return pd.read_csv(f, **kwargs)
+
+    def to_csv(self, df:pd.DataFrame, fname:str, **kwargs):
+        buf = io.BytesIO()
+        df.to_csv(buf, compression=_compression(fname), **kwargs)
+        buf.seek(0)
+        self._write_stream(buf, fname, contenttype='text/csv')
+        return self
+
+    def read_parquet(self, fname:str, **kwargs):
+        return pd.read_parquet(self.url(fname), **kwargs)
+
+    def read_parquet_dataset(self, fname:str, columns=None, filters=None):
+        """
+        Hive partitioned parquet directory fname as one DataFrame. pyarrow takes the schema
+        from the first partition, which drops columns only later partitions have; here the
+        schemas of all partitions matched by filters are unified first.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+        partitioning = ds.HivePartitioning.discover(infer_dictionary=True)
+        dataset = ds.dataset(self.url(fname), format='parquet', partitioning=partitioning)
+        expr = pq.filters_to_expression(filters) if filters else None
+        schemas = [x.physical_schema for x in dataset.get_fragments(filter=expr)]
+        schema = pa.unify_schemas(schemas + [dataset.schema])
+        dataset = ds.dataset(self.url(fname), schema=schema, format='parquet', partitioning=partitioning)
+        return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+    def to_parquet(self, df:pd.DataFrame, fname:str, **kwargs):
+        buf = io.BytesIO()
+        df.to_parquet(buf, **kwargs)
+        buf.seek(0)
+        self._write_stream(buf, fname, contenttype='application/octet-stream')
+        return self
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+def get_cloud_client():
+    """
+    one google cloud storage client per process; it keeps its own pooled http session
+    """
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            from google.cloud import storage as gcs
+            _CLIENT = gcs.Client()
+    return _CLIENT
+
+
+class CloudStorage(Storage):
+    def __init__(self, bucketname:str=None):
+        if bucketname is None:
+            bucketname = os.environ['BUCKETNAME']
+        self.bucketname = bucketname
+        self.bucket = get_cloud_client().bucket(bucketname)
+
+    def _read_bytes(self, fname):
+        from google.api_core.exceptions import NotFound
+        try:
+            return self.bucket.blob(fname).download_as_bytes()
+        except NotFound:
+            raise FileNotFoundError(self.url(fname))
+
+    def _write_stream(self, strm, fname, contenttype=None, size=None):
+        #upload_from_file reads the stream in chunks, no full copy is made here;
+        #without size it does a resumable upload, which calls strm.tell()
+        self.bucket.blob(fname).upload_from_file(strm, size=size, content_type=contenttype)
+
+    def listdir(self, prefix):
+        blobs = get_cloud_client().list_blobs(self.bucketname, prefix=prefix)
+        return [StoredBlob(x.name, x.updated, x.size) for x in blobs]
+
+    def exists(self, fname):
+        return self.bucket.blob(fname).exists()
+
+    def size(self, fname):
+        blob = self.bucket.get_blob(fname)
+        return None if blob is None else blob.size
+
+    def delete(self, fname):
+        from google.api_core.exceptions import NotFound
+        try:
+            self.bucket.blob(fname).delete()
+        except NotFound:
+            pass
+        return self
+
+    def url(self, fname):
+        return 'gs://{bucketname}/{fname}'.format(bucketname=self.bucketname, fname=fname)
+
+    def spec(self):
+        return ('gs', self.bucketname)
+
+
+class LocalStorage(Storage):
+    def __init__(self, rootdir:str):
+        self.rootdir = rootdir
+
+    def url(self, fname):
+        return os.path.join(self.rootdir, *fname.split('/'))
+
+    def spec(self):
+        return ('local', self.rootdir)
+
+    def _read_bytes(self, fname):
+        with open(self.url(fname), 'rb') as f:
+            return f.read()
+
+    def open_read(self, fname):
+        return open(self.url(fname), 'rb')
+
+    def _write_stream(self, strm, fname, contenttype=None, size=None):
+        path = self.url(fname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #write to a temp name first, readers never see half written files
+        tmppath = '{path}.{pid}_{tid}.part'.format(path=path, pid=os.getpid(), tid=threading.get_ident())
+        with open(tmppath, 'wb') as f:
+            shutil.copyfileobj(strm, f)
+        os.replace(tmppath, path)
+
+    def listdir(self, prefix):
+        #prefix semantics like the cloud: 'a/b' matches a/b/..., a/bc, ...
+        fdir = self.url(prefix) if prefix.endswith('/') else os.path.dirname(self.url(prefix))
+        blobs = []
+        for dirpath, dirs, fns in os.walk(fdir):
+            reldir = os.path.relpath(dirpath, self.rootdir).replace(os.sep, '/')
+            reldir = '' if reldir == '.' else reldir + '/'
+            dirs[:] = [x for x in dirs if (reldir + x).startswith(prefix) or prefix.startswith(reldir + x + '/')]
+            for fn in fns:
+                path = os.path.join(dirpath, fn)
+                name = os.path.relpath(path, self.rootdir).replace(os.sep, '/')
+                if not name.startswith(prefix) or name.endswith('.part'):
+                    continue
+                stat = os.stat(path)
+                updated = datetime.datetime.fromtimestamp(stat.st_mtime, tz=datetime.timezone.utc)
+                blobs.append(StoredBlob(name, updated, stat.st_size))
+        return sorted(blobs, key=lambda x: x.name)
+
+    def exists(self, fname):
+        return os.path.exists(self.url(fname))
+
+    def size(self, fname):
+        path = self.url(fname)
+        return os.path.getsize(path) if os.path.exists(path) else None
+
+    def delete(self, fname):
+        try:
+            os.remove(self.url(fname))
+        except FileNotFoundError:
+            pass
+        return self
+
+
+def is_immutable(fname:str):
+    """
+    downloaded EDINET documents never change once issued; meta, ledger and parsed output do
+    """
+    return any(['/{x}/'.format(x=x) in fname for x in ['csv', 'zip', 'pdf']])
+
+
+class CachedStorage(Storage):
+    """
+    Read-through cache on local disk in front of backend. Writes go to the backend and
+    the cache. Immutable documents (see is_immutable) are cached for good, everything
+    else for mutable_ttl seconds.
+    """
+    def __init__(self, backend:Storage, cachedir:str, mutable_ttl:float=60):
+        self.backend = backend
+        self.cache = LocalStorage(cachedir)
+        self.mutable_ttl = mutable_ttl
+
+    def _is_cached(self, fname):
+        path = self.cache.url(fname)
+        if not os.path.exists(path):
+            return False
+        return is_immutable(fname) or (time.time() - os.path.getmtime(path)) < self.mutable_ttl
+
+    def _read_bytes(self, fname):
+        if not self._is_cached(fname):
+            self.cache._write_stream(io.BytesIO(self.backend._read_bytes(fname)), fname)
+        return self.cache._read_bytes(fname)
+
+    def open_read(self, fname):
+        if not self._is_cached(fname):
+            self.cache._write_stream(io.BytesIO(self.backend._read_bytes(fname)), fname)
+        return self.cache.open_read(fname)
+
+    def _write_stream(self, strm, fname, contenttype=None, size=None):
+        self.cache._write_stream(strm, fname)
+        with self.cache.open_read(fname) as f:
+            self.backend._write_stream(f, fname, contenttype=contenttype, size=self.cache.size(fname))
+
+    def listdir(self, prefix):
+        return self.backend.listdir(prefix)
+
+    def exists(self, fname):
+        return self._is_cached(fname) or self.backend.exists(fname)
+
+    def size(self, fname):
+        if self._is_cached(fname):
+            return self.cache.size(fname)
+        return self.backend.size(fname)
+
+    def delete(self, fname):
+        self.backend.delete(fname)
+        self.cache.delete(fname)
+        return self
+
+    def url(self, fname):
+        return self.backend.url(fname)
+
+    def spec(self):
+        return ('cached', self.backend.spec(), self.cache.rootdir, self.mutable_ttl)
+
+
+_STORAGE = None
+_STORAGE_LOCK = threading.Lock()
+
+def get_storage():
+    global _STORAGE
+    with _STORAGE_LOCK:
+        if _STORAGE is None:
+            target = os.environ.get('EDINET_STORAGE', 'gs')
+            if target == 'gs':
+                backend = CloudStorage()
+            else:
+                backend = LocalStorage(target)
+            cachedir = os.environ.get('EDINET_CACHE_DIR')
+            if cachedir:
+                backend = CachedStorage(backend, cachedir)
+            _STORAGE = backend
+    return _STORAGE
+
+def set_storage(backend:Storage):
+    """
+    override the process default, e.g. set_storage(LocalStorage('C:/tmp/bucket'))
+    """
+    global _STORAGE
+    with _STORAGE_LOCK:
+        _STORAGE = backend
+    return backend
+
+def from_spec(spec:tuple):
+    """
+    inverse of Storage.spec()
+    """
+    if spec[0] == 'gs':
+        return CloudStorage(spec[1])
+    if spec[0] == 'local':
+        return LocalStorage(spec[1])
+    if spec[0] == 'cached':
+        return CachedStorage(from_spec(spec[1]), spec[2], mutable_ttl=spec[3])
+    raise ValueError('unknown storage spec {spec}'.format(spec=spec))
+
+def init_worker(spec:tuple):
+    """
+    ProcessPoolExecutor initializer: spawned workers start from the environment again,
+    this gives them the parent's backend, e.g. initargs=(get_storage().spec(),)
+    """
+    set_storage(from_spec(spec))